@@ -0,0 +1,175 @@
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import platform
+import main as converter
+from generate_module import generate_module
+from main import open_fur_file, open_tic_file, get_song_info, get_instrument, get_wavetable, get_pattern, convert_instrument, convert_wavetable, convert_pattern, encode_base64, decode_base64, shorten_base64, expand_base64, compress_base64, recompress_for_huffman, decompress_base64, count_bytes, generate_huffman_lengths, generate_canonical_huffman_codes, build_huffman_lookup, compress_huffman, decompress_huffman, TicCart, convert
+
+MODULES = ["MainTic20.fur"]
+GENERATED_PATTERNS = [10, 20, 40] # pattern counts per channel of the generated modules which are benchmarked too
+RESULTS_NAME = "benchmark_results.json"
+BASELINE_NAME = "benchmark_baseline.json"
+REPEATS = 5
+TOLERANCE = 1.25 # a stage is a regression if it's this many times slower than in the baseline...
+NOISE_FLOOR = 0.002 # ...and slower by at least this many seconds
+
+
+
+def time_stage(function, repeats):
+	# the best of several runs; logging isn't set up here, so the converter's diagnostics aren't even formatted
+	best = None
+	for i in range(repeats):
+		start_time = time.perf_counter()
+		function()
+		elapsed = time.perf_counter() - start_time
+		if best == None or elapsed < best:
+			best = elapsed
+	return best
+
+def compress_all(tests):
+	converter.compress_memo.clear() # otherwise every run after the first one is just a memo lookup
+	compressed = [compress_base64(test) for test in tests]
+	# with the Huffman cost rounds, which go through every half when there's no build state
+	return recompress_for_huffman(tests, compressed, list(range(len(tests))), lambda data, costs: [compress_base64(item, costs) for item in data])[0]
+
+def encode_huffman(b64_patterns):
+	lengths = generate_huffman_lengths(count_bytes("".join(b64_patterns)))
+	codes = generate_canonical_huffman_codes(lengths)
+	return codes, [encode_base64(compress_huffman(pattern, codes)) for pattern in b64_patterns]
+
+def decode_music(codes, patterns):
+	lookup = build_huffman_lookup(codes)
+	return [decode_base64(decompress_base64(expand_base64(decompress_huffman(decode_base64(pattern), lookup).decode()))) for pattern in patterns]
+
+def pack_cart(cart_data, chunks):
+	cart = TicCart(cart_data)
+	for type in chunks:
+		cart.replace_chunk(type, chunks[type])
+	return cart.pack()
+
+def convert_all(path, work_dir):
+	# the whole conversion from scratch: fresh compression cache and no build state
+	converter.compress_memo.clear()
+	converter.COMPRESS_CACHE_NAME = os.path.join(work_dir, "compress_cache.db")
+	if os.path.exists(converter.COMPRESS_CACHE_NAME):
+		os.remove(converter.COMPRESS_CACHE_NAME)
+	convert(path, os.path.join(work_dir, "cart.tic"), os.path.join(work_dir, "music_data.txt"), 1, converter.CARTRIDGE_NAME)
+
+
+
+def benchmark_module(path, repeats):
+	stages = {}
+
+	stages["decompress"] = time_stage(lambda: open_fur_file(path), repeats)
+	data = open_fur_file(path)
+	stages["header"] = time_stage(lambda: get_song_info(data), repeats)
+	info = get_song_info(data)
+
+	stages["parse_instruments"] = time_stage(lambda: [get_instrument(data, ptr) for ptr in info["instrument_ptrs"]], repeats)
+	stages["parse_wavetables"] = time_stage(lambda: [get_wavetable(data, ptr) for ptr in info["wavetable_ptrs"]], repeats)
+	stages["parse_patterns"] = time_stage(lambda: [get_pattern(data, ptr, info["pattern_length"], info["effect_columns"]) for ptr in info["pattern_ptrs"]], repeats)
+	instruments = [get_instrument(data, ptr) for ptr in info["instrument_ptrs"]]
+	wavetables = [get_wavetable(data, ptr) for ptr in info["wavetable_ptrs"]]
+	patterns = [get_pattern(data, ptr, info["pattern_length"], info["effect_columns"]) for ptr in info["pattern_ptrs"]]
+
+	stages["convert_instruments"] = time_stage(lambda: [convert_instrument(instrument) for instrument in instruments], repeats)
+	stages["convert_wavetables"] = time_stage(lambda: [convert_wavetable(wavetable) for wavetable in wavetables], repeats)
+	stages["convert_patterns"] = time_stage(lambda: [convert_pattern(patterns[i], patterns[i - 1] if i > 0 else None) for i in range(len(patterns))], repeats)
+	converted_instruments = b"".join([convert_instrument(instrument) for instrument in instruments])
+	converted_wavetables = b"".join([convert_wavetable(wavetable) for wavetable in wavetables])
+	converted = [convert_pattern(patterns[i], patterns[i - 1] if i > 0 else None) for i in range(len(patterns))]
+
+	tests = []
+	for pattern in converted:
+		for i in range(2):
+			test = shorten_base64(encode_base64(pattern[i*192:(i+1)*192]))
+			if not test in tests:
+				tests.append(test)
+	stages["compress"] = time_stage(lambda: compress_all(tests), repeats)
+	b64_patterns = compress_all(tests)
+	stages["huffman"] = time_stage(lambda: encode_huffman(b64_patterns), repeats)
+	codes, music_patterns = encode_huffman(b64_patterns)
+	stages["verify"] = time_stage(lambda: decode_music(codes, music_patterns), repeats)
+
+	cart_data = open_tic_file(converter.CARTRIDGE_NAME)
+	chunks = {10: converted_wavetables, 9: converted_instruments, 15: b"".join(converted)}
+	stages["cart"] = time_stage(lambda: pack_cart(cart_data, chunks), repeats)
+
+	work_dir = tempfile.mkdtemp()
+	cache_name = converter.COMPRESS_CACHE_NAME
+	stages["total"] = time_stage(lambda: convert_all(path, work_dir), repeats)
+	converter.COMPRESS_CACHE_NAME = cache_name
+	shutil.rmtree(work_dir)
+
+	return {"size": os.path.getsize(path), "patterns": len(patterns), "pattern_halves": len(tests), "stages": stages}
+
+def compare(results, baseline):
+	# returns the descriptions of all stages which got slower than in the baseline
+	out = []
+	for name in results["modules"]:
+		if not name in baseline["modules"]:
+			continue
+		for stage in results["modules"][name]["stages"]:
+			old = baseline["modules"][name]["stages"].get(stage)
+			new = results["modules"][name]["stages"][stage]
+			if old != None and new > old * TOLERANCE and new - old > NOISE_FLOOR:
+				out.append(name + " / " + stage + ": " + ("%.4f" % old) + " s -> " + ("%.4f" % new) + " s")
+	return out
+
+
+
+def main():
+	parser = argparse.ArgumentParser(description = "Times every stage of the conversion and compares the results with " + BASELINE_NAME + ".")
+	parser.add_argument("modules", nargs = "*", default = MODULES, help = "the .fur files to benchmark (default: " + ", ".join(MODULES) + ")")
+	parser.add_argument("--generated", type = int, nargs = "*", default = GENERATED_PATTERNS, help = "pattern counts per channel of generated modules to benchmark (default: " + " ".join([str(n) for n in GENERATED_PATTERNS]) + ")")
+	parser.add_argument("--repeats", type = int, default = REPEATS, help = "how many times every stage is run, the best time counts")
+	parser.add_argument("--save-baseline", action = "store_true", help = "store the results as the new baseline")
+	args = parser.parse_args()
+
+	# the generated modules are always the same, so their times can be compared between runs
+	generated_dir = tempfile.mkdtemp()
+	paths = list(args.modules)
+	for patterns in args.generated:
+		path = os.path.join(generated_dir, "generated_" + str(patterns) + ".fur")
+		file = open(path, "wb")
+		file.write(generate_module(patterns))
+		file.close()
+		paths.append(path)
+
+	results = {"python": platform.python_version(), "repeats": args.repeats, "modules": {}}
+	for path in paths:
+		name = os.path.basename(path)
+		print("Benchmarking " + name + "...")
+		results["modules"][name] = benchmark_module(path, args.repeats)
+		for stage, seconds in results["modules"][name]["stages"].items():
+			print("  " + stage.ljust(24) + ("%.4f" % seconds).rjust(10) + " s")
+
+	shutil.rmtree(generated_dir)
+
+	file = open(RESULTS_NAME, "w")
+	json.dump(results, file, indent = "\t")
+	file.close()
+
+	if args.save_baseline:
+		shutil.copyfile(RESULTS_NAME, BASELINE_NAME)
+		print("Saved as the baseline")
+	elif os.path.exists(BASELINE_NAME):
+		file = open(BASELINE_NAME, "r")
+		baseline = json.load(file)
+		file.close()
+		regressions = compare(results, baseline)
+		for regression in regressions:
+			print("REGRESSION: " + regression)
+		if len(regressions) > 0:
+			sys.exit(1)
+		print("No regressions against the baseline")
+
+
+
+if __name__ == "__main__":
+	main()
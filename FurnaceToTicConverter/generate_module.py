@@ -0,0 +1,174 @@
+import zlib
+import struct
+import random
+import argparse
+from main import CHANNEL_COUNT
+
+OUTPUT_NAME = "generated.fur"
+VERSION = 157 # the module version written to the header
+PATTERN_LENGTH = 128 # the converter only supports 128 rows long patterns
+INFO_PTR = 32
+MAX_INSTRUMENTS = 64 # TIC-80 has 6 bits for the instrument number
+MAX_WAVETABLES = 16
+MAX_PATTERNS = 256 # per channel, since the orders are single bytes
+CART_PATTERNS = 42 # per channel; the converter can't fit more into the patterns chunk of a cart (65535 bytes, 384 bytes per pattern)
+MOTIF_LENGTH = 16 # rows repeat this far back
+ORDER_PATTERNS = 7 # the tracks can only point at the first 31 patterns, so the orders loop through this many patterns of each channel
+
+
+
+def pack_string(s):
+	return s.encode() + b"\0"
+
+def pack_block(id, contents):
+	return id + struct.pack("<I", len(contents)) + contents
+
+def pack_macro(code, data, loop = 255):
+	# header: code, length, loop, release, mode, open/type/word size, delay, speed
+	return bytes([code, len(data), loop, 255, 0, 0, 0, 1]) + bytes(data)
+
+
+
+def generate_instrument(rng, index, wavetable_count):
+	macros = b""
+	macros += pack_macro(0, [15, 15, 15, 15, rng.randint(1, 15)]) # the fifth value is used as the decay
+	if rng.random() < 0.5:
+		macros += pack_macro(1, [rng.choice([0, 3, 4, 7, 12]) for i in range(rng.randint(1, 8))])
+	macros += pack_macro(3, [rng.randrange(wavetable_count)])
+	macros += b"\xff"
+
+	name = pack_string("Instrument " + str(index))
+	contents = struct.pack("<HH", 157, 0)
+	contents += b"NA" + struct.pack("<H", len(name)) + name
+	contents += b"MA" + struct.pack("<HH", len(macros) + 2, 8) + macros
+	contents += b"EN"
+	return pack_block(b"INS2", contents)
+
+def generate_wavetable(rng, index):
+	contents = pack_string("Wave " + str(index))
+	contents += struct.pack("<III", 32, 0, 15) # width, reserved, height
+	contents += struct.pack("<32I", *[rng.randint(0, 15) for i in range(32)])
+	return pack_block(b"WAVE", contents)
+
+def generate_row(rng, density, instrument_count, effect_columns):
+	# note, octave, instrument, volume, then effect and value pairs; 65535 is an empty cell
+	row = [0, 0, 65535, 65535] + [65535, 65535] * effect_columns
+	if rng.random() < density:
+		if rng.random() < 0.1:
+			row[0] = 100 # note off
+		else:
+			row[0] = rng.randint(1, 12)
+			row[1] = rng.randint(0, 5)
+			row[2] = rng.randrange(instrument_count)
+			if rng.random() < 0.5:
+				row[3] = rng.randint(0, 15)
+		if rng.random() < 0.2:
+			row[4] = rng.choice([0, 3]) # arpeggio or portamento, the only ones that are converted
+			row[5] = rng.randint(0, 255 if row[4] == 0 else 63) # the portamento speed is multiplied by 4 and has to fit in a byte
+	return row
+
+def generate_pattern(rng, channel, index, density, repetition, instrument_count, effect_columns):
+	rows = []
+	for i in range(PATTERN_LENGTH):
+		if i >= MOTIF_LENGTH and rng.random() < repetition:
+			rows.append(rows[i - MOTIF_LENGTH])
+		else:
+			rows.append(generate_row(rng, density, instrument_count, effect_columns))
+	values = [value for row in rows for value in row]
+
+	contents = struct.pack("<HHHH", channel, index, 0, 0) # channel, index, subsong, reserved
+	contents += struct.pack("<" + str(len(values)) + "H", *values)
+	contents += pack_string("")
+	return pack_block(b"PATR", contents)
+
+def generate_info(ptrs, counts, orders, effect_columns):
+	contents = struct.pack("<BBBBf", 0, 6, 6, 1, 60.0) # time base, speeds, arpeggio time, ticks per second
+	contents += struct.pack("<HHBB", PATTERN_LENGTH, len(orders[0]), 4, 16)
+	contents += struct.pack("<HHHI", counts["instruments"], counts["wavetables"], 0, counts["patterns"])
+	contents += bytes([0x96]) + bytes(31) # WonderSwan
+	contents += bytes([64]) + bytes(31) # chip volumes
+	contents += bytes(32) # chip panning
+	contents += bytes(128) # chip flag pointers
+	contents += pack_string("Generated") + pack_string("generate_module.py")
+	contents += struct.pack("<f", 440.0) + bytes(20) # A-4 tuning and compatibility flags
+	for name in ["instruments", "wavetables", "patterns"]:
+		contents += struct.pack("<" + str(len(ptrs[name])) + "I", *ptrs[name])
+	for channel in range(CHANNEL_COUNT):
+		contents += bytes(orders[channel])
+	contents += bytes(effect_columns)
+	contents += bytes(CHANNEL_COUNT) * 2 # hidden and collapsed channels
+	contents += b"".join([pack_string("Channel " + str(i + 1)) for i in range(CHANNEL_COUNT)])
+	contents += b"".join([pack_string("CH" + str(i + 1)) for i in range(CHANNEL_COUNT)])
+	contents += pack_string("") + struct.pack("<f", 1.0) + bytes(28) # comment, master volume, extended compatibility flags
+	contents += struct.pack("<HH", 150, 150) # virtual tempo
+	contents += pack_string("") + pack_string("") # first subsong name and comment
+	contents += bytes(4) # no more subsongs
+	contents += pack_string("WonderSwan") + pack_string("") * 5
+	contents += struct.pack("<fffI", 1.0, 0.0, 0.0, 0) # chip volume, panning, balance, no patchbay connections
+	contents += bytes([1, 0]) + bytes(7) + bytes([1]) + bytes([6]) + bytes(15) + bytes([0])
+	return pack_block(b"INFO", contents)
+
+def generate_module(patterns = 32, density = 0.5, effect_columns = 1, repetition = 0.5, instruments = 8, wavetables = 8, seed = 0):
+	# patterns is the count for each channel; returns the compressed module
+	if patterns < 1 or patterns > MAX_PATTERNS:
+		raise ValueError("pattern count must be between 1 and " + str(MAX_PATTERNS))
+	if instruments < 1 or instruments > MAX_INSTRUMENTS:
+		raise ValueError("instrument count must be between 1 and " + str(MAX_INSTRUMENTS))
+	if wavetables < 1 or wavetables > MAX_WAVETABLES:
+		raise ValueError("wavetable count must be between 1 and " + str(MAX_WAVETABLES))
+	if effect_columns < 1 or effect_columns > 8:
+		raise ValueError("effect column count must be between 1 and 8")
+	rng = random.Random(seed)
+	effect_columns = [effect_columns] * CHANNEL_COUNT
+
+	blocks = {"instruments": [], "wavetables": [], "patterns": []}
+	for i in range(instruments):
+		blocks["instruments"].append(generate_instrument(rng, i, wavetables))
+	for i in range(wavetables):
+		blocks["wavetables"].append(generate_wavetable(rng, i))
+	for i in range(patterns):
+		for channel in range(CHANNEL_COUNT):
+			blocks["patterns"].append(generate_pattern(rng, channel, i, density, repetition, instruments, effect_columns[channel]))
+	counts = {name: len(blocks[name]) for name in blocks}
+
+	# the size of the INFO block doesn't depend on the pointers, so it's generated once to find where the other blocks start
+	orders = [[i % min(patterns, ORDER_PATTERNS) for i in range(patterns)] for channel in range(CHANNEL_COUNT)]
+	ptrs = {name: [0] * counts[name] for name in blocks}
+	ptr = INFO_PTR + len(generate_info(ptrs, counts, orders, effect_columns))
+	for name in ["instruments", "wavetables", "patterns"]:
+		for i in range(counts[name]):
+			ptrs[name][i] = ptr
+			ptr += len(blocks[name][i])
+
+	data = b"-Furnace module-" + struct.pack("<HHI", VERSION, 0, INFO_PTR) + bytes(8)
+	data += generate_info(ptrs, counts, orders, effect_columns)
+	for name in ["instruments", "wavetables", "patterns"]:
+		data += b"".join(blocks[name])
+	return zlib.compress(data)
+
+
+
+def main():
+	parser = argparse.ArgumentParser(description = "Generates a random Furnace module which the converter can read, for testing how it scales.")
+	parser.add_argument("output", nargs = "?", default = OUTPUT_NAME, help = "where to save the module (default: " + OUTPUT_NAME + ")")
+	parser.add_argument("--patterns", type = int, default = 32, help = "how many patterns every channel has")
+	parser.add_argument("--density", type = float, default = 0.5, help = "the chance of a row having a note, from 0 to 1")
+	parser.add_argument("--effect-columns", type = int, default = 1, help = "effect columns in every channel")
+	parser.add_argument("--repetition", type = float, default = 0.5, help = "the chance of a row repeating the one " + str(MOTIF_LENGTH) + " rows earlier, from 0 to 1")
+	parser.add_argument("--instruments", type = int, default = 8)
+	parser.add_argument("--wavetables", type = int, default = 8)
+	parser.add_argument("--seed", type = int, default = 0)
+	args = parser.parse_args()
+
+	data = generate_module(args.patterns, args.density, args.effect_columns, args.repetition, args.instruments, args.wavetables, args.seed)
+	file = open(args.output, "wb")
+	file.write(data)
+	file.close()
+	print("Saved " + args.output + " (" + str(len(data)) + " bytes)")
+	if args.patterns > CART_PATTERNS:
+		print("Warning: with more than " + str(CART_PATTERNS) + " patterns per channel the converted patterns won't fit in a cart")
+
+
+
+if __name__ == "__main__":
+	main()
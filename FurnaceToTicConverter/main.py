@@ -1,21 +1,83 @@
 import zlib
+import re
+import sys
+import mmap
+import time
+import hashlib
+import os
+import json
+import sqlite3
+import tempfile
+import argparse
+import traceback
+import logging
+import tracemalloc
 import struct
+import heapq
+import base64
+from array import array
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
 
 FILE_NAME = "MainTic20.fur"
 CARTRIDGE_NAME = "chainblast2.tic"
+MUSIC_DATA_NAME = "music_data.txt"
+BUILD_STATE_NAME = "build_state.json" # what was converted last time, so that only the changes have to be converted again
+COMPRESS_CACHE_NAME = "compress_cache.db"
+PROFILE_NAME = "profile.json" # where --profile saves the report
 CHANNEL_COUNT = 4 # depends on sound chip used! Wonderswan reccomended
 NOTE_PREFIXES = ["  ","C#","D-","D#","E-","F-","F#","G-","G#","A-","A#","B-","C-"]
+NOTE_VALUES = [0] + [note + 4 for note in range(1, 12)] + [4] # TIC-80 values of the notes 0-12, note offs (100 and above) are 1
 BASE64_CHARS = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_"
+STANDARD_BASE64_CHARS = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/"
+COMPRESS_SYMBOLS = BASE64_CHARS + "@$%^#[]" # every symbol the compressed patterns can have, see shorten_base64 and compress_base64
+HUFFMAN_LOOKUP_BITS = 10 # how many bits the Huffman decoder looks up at once, longer codes go through subtables
+FUR_STREAM_CHUNK_SIZE = 16384 # how many compressed bytes are inflated at once when streaming a module
+COMPRESS_VERSION = "2" # change it whenever compress_base64 starts producing different output, so that the cached results aren't used
+COMPRESS_CACHE_SIZE = 4194304 # max amount of characters kept in the compression cache file
+PARSE_CACHE_SIZE = 4096 # max amount of parsed blocks kept in watch mode, the cache is emptied when it's full
+WATCH_INTERVAL = 0.2 # how often the module is checked for changes in watch mode, in seconds
+WATCH_DEBOUNCE = 0.3 # how long the module must stay unchanged before it's converted, in seconds
+STRING_SEARCH_SIZE = 64 # how many bytes are searched for the end of a string at first, twice as many every next time
+COMPRESS_MEMO_SIZE = 16384 # max amount of substrings remembered by compress_base64, the oldest ones are evicted first
+COMPRESS_ROUNDS = 3 # max amount of times the patterns are compressed again with the costs of the last Huffman code
 
-read_ptr = 0
+BASE64_VALUES = {}
+for i in range(64):
+	BASE64_VALUES[BASE64_CHARS[i]] = i
+UNIT_COSTS = {symbol: 1 for symbol in COMPRESS_SYMBOLS}
+BYTE_BITS_REVERSED = bytes([int(format(i, "08b")[::-1], 2) for i in range(256)])
+# maps the standard base64 characters to ours, whose values have their 6 bits reversed
+BASE64_ENCODE_TABLE = str.maketrans(STANDARD_BASE64_CHARS, "".join([BASE64_CHARS[int(format(i, "06b")[::-1], 2)] for i in range(64)]))
+BASE64_DECODE_TABLE = str.maketrans("".join([BASE64_CHARS[int(format(i, "06b")[::-1], 2)] for i in range(64)]), STANDARD_BASE64_CHARS)
 
+logger = logging.getLogger(__name__) # the diagnostics are only formatted if their level is enabled, see --verbose and --quiet
+compress_memo = OrderedDict()
+profile_counters = {} # amounts of work done during the conversion, reported in profile mode
 
 
-def open_fur_file(path):
+
+def add_counter(name, amount = 1):
+	profile_counters[name] = profile_counters.get(name, 0) + amount
+
+
+
+def open_fur_file(path, stream = False):
+	# with stream enabled, the file is memory-mapped and only inflated as far as it is read (see FurStream)
+	if stream:
+		file = open(path, "rb")
+		contents = mmap.mmap(file.fileno(), 0, access = mmap.ACCESS_READ)
+		file.close()
+		if contents[:16] == b"-Furnace module-": # not compressed at all
+			return memoryview(contents)
+		return FurStream(contents)
+	
 	file = open(path, "rb")
 	contents = file.read()
 	file.close()
-
+	
+	if contents[:16] == b"-Furnace module-":
+		return contents
 	return zlib.decompress(contents)
 
 def open_tic_file(path):
@@ -25,149 +87,437 @@ def open_tic_file(path):
 	
 	return contents
 
-def save_tic_file(path, contents):
-	file = open(path, "wb")
-	file.write(contents)
-	file.close()
+def save_file(path, contents):
+	# the contents can be bytes or text; returns False if the file already has these contents, then it isn't touched at all
+	# otherwise they're written to a temporary file which then replaces the old one, so the file is never left half-written
+	binary = type(contents) is not str
+	if os.path.exists(path):
+		file = open(path, "rb" if binary else "r")
+		old_contents = file.read()
+		file.close()
+		if old_contents == contents:
+			logger.debug("%s hasn't changed, not saving it", path)
+			return False
+	
+	# the temporary file is only readable by its owner, so it gets the permissions the file has (or would get) instead
+	if os.path.exists(path):
+		mode = os.stat(path).st_mode & 0o777
+	else:
+		umask = os.umask(0)
+		os.umask(umask)
+		mode = 0o666 & ~umask
+	fd, temp_path = tempfile.mkstemp(prefix = os.path.basename(path) + ".", suffix = ".tmp", dir = os.path.dirname(os.path.abspath(path)))
+	file = os.fdopen(fd, "wb" if binary else "w")
+	try:
+		os.chmod(temp_path, mode)
+		file.write(contents)
+		file.flush()
+		os.fsync(file.fileno())
+		file.close()
+		os.replace(temp_path, path)
+	except BaseException:
+		file.close()
+		os.remove(temp_path)
+		raise
+	return True
+
+TIC_CHUNK_HEADER = struct.Struct("<BHB") # type (low 5 bits) and bank (high 3 bits), size, reserved
+TIC_CHUNK_MAX_SIZE = 65535
+TIC_CODE_CHUNK = 5
+TIC_CODE_ZIP_CHUNK = 16 # the code compressed with zlib
+MUSIC_DATA_START = "-- <MUSIC_DATA>" # the music data is put between these lines in the code of the cart with --inject
+MUSIC_DATA_END = "-- </MUSIC_DATA>"
+CART_BRACKETS = str.maketrans("[]", "{}") # the b64unp function of the cart reads the repeats as #n{base}, so the symbols are written like that in the music data
+CONVERTER_BRACKETS = str.maketrans("{}", "[]")
+MUSIC_DATA_TABLES = [r"^M_DATA = \{\n.*?^\}\n", r"^M_CODE = [^\n]*\n", r"^M_PATTERNS = [^\n]*\n"] # the tables of the music data file, as pasted into the code
+
+class TicCart:
+	# the chunk headers of a cart, indexed over a view of the file; the chunks themselves aren't copied
+	# when packing, only the replaced chunks are rebuilt and the spans of the file between them are copied as they are
+	def __init__(self, data):
+		self.data = memoryview(data)
+		self.chunks = [] # in the order of the file; "data" is None unless the chunk was replaced
+		ptr = 0
+		while ptr < len(self.data):
+			type_bank, size, reserved = TIC_CHUNK_HEADER.unpack_from(self.data, ptr)
+			self.chunks.append({"type": type_bank & 31, "bank": type_bank >> 5, "ptr": ptr, "size": size, "data": None})
+			logger.debug("Chunk of type %s in bank %s has %s bytes", type_bank & 31, type_bank >> 5, size)
+			ptr += TIC_CHUNK_HEADER.size + size
+	
+	def find_chunk(self, type, bank = 0):
+		for chunk in self.chunks:
+			if chunk["type"] == type and chunk["bank"] == bank:
+				return chunk
+		return None
+	
+	def get_chunk(self, type, bank = 0):
+		# returns the contents of the chunk, or None if the cart doesn't have it
+		chunk = self.find_chunk(type, bank)
+		if chunk == None:
+			return None
+		if chunk["data"] != None:
+			return chunk["data"]
+		return self.data[chunk["ptr"]+TIC_CHUNK_HEADER.size:chunk["ptr"]+TIC_CHUNK_HEADER.size+chunk["size"]]
+	
+	def replace_chunk(self, type, data, bank = 0):
+		# returns False if the chunk already had this data, then it's left as it is
+		if len(data) > TIC_CHUNK_MAX_SIZE:
+			raise ValueError("Chunk of type " + str(type) + " would have " + str(len(data)) + " bytes, but it can't have more than " + str(TIC_CHUNK_MAX_SIZE))
+		if self.get_chunk(type, bank) == data:
+			return False
+		chunk = self.find_chunk(type, bank)
+		if chunk == None:
+			# create a new chunk if not found
+			chunk = {"type": type, "bank": bank, "ptr": None}
+			self.chunks.append(chunk)
+		chunk["data"] = data
+		chunk["size"] = len(data)
+		return True
+	
+	def get_code(self):
+		# only carts with all the code in the first bank are supported
+		for chunk in self.chunks:
+			if (chunk["type"] == TIC_CODE_CHUNK or chunk["type"] == TIC_CODE_ZIP_CHUNK) and chunk["bank"] != 0:
+				raise ValueError("Carts with code in more than one bank aren't supported")
+		data = self.get_chunk(TIC_CODE_ZIP_CHUNK)
+		if data != None:
+			return zlib.decompress(data)
+		data = self.get_chunk(TIC_CODE_CHUNK)
+		if data != None:
+			return bytes(data)
+		return b""
+	
+	def set_code(self, code):
+		# the code is kept in the same form as it was in the cart
+		if self.find_chunk(TIC_CODE_ZIP_CHUNK) != None:
+			if zlib.decompress(self.get_chunk(TIC_CODE_ZIP_CHUNK)) != code: # the compressed data could differ even if the code didn't
+				self.replace_chunk(TIC_CODE_ZIP_CHUNK, zlib.compress(code, 9))
+		else:
+			self.replace_chunk(TIC_CODE_CHUNK, code)
+	
+	def is_changed(self):
+		for chunk in self.chunks:
+			if chunk["data"] != None:
+				return True
+		return False
+	
+	def pack(self):
+		parts = []
+		span_start = None # the unchanged chunks next to each other are copied in one go
+		for chunk in self.chunks:
+			if chunk["data"] == None:
+				if span_start == None:
+					span_start = chunk["ptr"]
+				span_end = chunk["ptr"] + TIC_CHUNK_HEADER.size + chunk["size"]
+			else:
+				if span_start != None:
+					parts.append(self.data[span_start:span_end])
+					span_start = None
+				parts.append(TIC_CHUNK_HEADER.pack(chunk["type"] + (chunk["bank"] << 5), chunk["size"], 0))
+				parts.append(chunk["data"])
+		if span_start != None:
+			parts.append(self.data[span_start:span_end])
+		
+		return b"".join(parts)
 
-def unpack_tic_cart(data):
-	global read_ptr
-	
-	read_ptr = 0
-	chunks = []
-	while read_ptr < len(data):
-		chunk = {}
-		chunk["type"] = read_int(data, 1)
-		chunk["size"] = read_int(data, 2)
-		read_ptr += 1
-		chunk["data"] = read_bytes(data, chunk["size"])
-		chunks.append(chunk)
-		print("Chunk of type " + str(chunk["type"]) + " has " + str(chunk["size"]) + " bytes")
-	
-	return chunks
-
-def pack_tic_cart(chunks):
-	data = bytearray()
-	for chunk in chunks:
-		data.append(chunk["type"])
-		data.append(chunk["size"] % 256)
-		data.append(int(chunk["size"] / 256))
-		data.append(0)
-		data += chunk["data"]
-	
-	return data
-
-def replace_tic_chunk(chunks, type, data):
-	for chunk in chunks:
-		if chunk["type"] == type:
-			chunk["data"] = data
-			chunk["size"] = len(data)
-			return
-	# create a new chunk if not found
-	new_chunk = {}
-	new_chunk["type"] = type
-	new_chunk["data"] = data
-	new_chunk["size"] = len(data)
-	chunks.append(new_chunk)
 
 
+def get_lua_function(code, name):
+	# the source of a top level function, None if the code doesn't have it
+	match = re.search(r"^function " + name + r"\(.*?^end\b", code, re.MULTILINE | re.DOTALL)
+	if match == None:
+		return None
+	return match.group(0)
+
+def check_music_decoders(code):
+	# the music data is only put into a cart which can decode it: humdec has to read the Huffman tree from M_CODE,
+	# and b64unp has to read the repeats with braces, see CART_BRACKETS
+	humdec = get_lua_function(code, "humdec")
+	b64unp = get_lua_function(code, "b64unp")
+	if humdec == None or b64unp == None:
+		raise ValueError("The code of the cart has no humdec and b64unp functions to decode the music data with")
+	if not "M_CODE" in humdec:
+		raise ValueError("humdec in the code of the cart doesn't read M_CODE, so it can't decode the music data")
+	if not "\"{\"" in b64unp or not "\"}\"" in b64unp:
+		raise ValueError("b64unp in the code of the cart doesn't read the repeats as #n{base}, so it can't decode the music data")
+
+def inject_music_data(code, music_data):
+	# replaces the code between the music data markers; without them, the music data goes in place of the first of the tables
+	# pasted from the music data file and the other ones are removed, and if there are none either, it goes at the start of the code
+	check_music_decoders(code)
+	region = MUSIC_DATA_START + "\n" + music_data + MUSIC_DATA_END
+	start = code.find(MUSIC_DATA_START)
+	if start != -1:
+		end = code.find(MUSIC_DATA_END, start)
+		if end == -1:
+			raise ValueError(MUSIC_DATA_START + " found in the code, but " + MUSIC_DATA_END + " is missing")
+		return code[:start] + region + code[end+len(MUSIC_DATA_END):]
+	spans = []
+	for table in MUSIC_DATA_TABLES:
+		match = re.search(table, code, re.MULTILINE | re.DOTALL)
+		if match != None:
+			spans.append(match.span())
+	if len(spans) > 0:
+		spans.sort()
+		out = code[:spans[0][0]] + region + "\n"
+		for i in range(1, len(spans)):
+			out += code[spans[i-1][1]:spans[i][0]]
+		return out + code[spans[-1][1]:]
+	return region + "\n" + code
 
 def encode_base64(data):
-	out = ""
-	current_byte = 0
-	current_bit = 0
-	
-	for byte in data:
-		for i in range(8):
-			n = (byte & (1 << i)) >> i
-			current_byte += n << current_bit
-			current_bit += 1
-			if current_bit == 6:
-				out += BASE64_CHARS[current_byte]
-				current_byte = 0
-				current_bit = 0
-	
-	if current_bit > 0:
-		out += BASE64_CHARS[current_byte]
+	# the standard codec reads the bits starting from the highest one and ours from the lowest one, so the bits are reversed on the way in and out
+	out = base64.b64encode(data.translate(BYTE_BITS_REVERSED)).decode().rstrip("=").translate(BASE64_ENCODE_TABLE)
 	# the first byte of the data indicates how many bits are meaningful in the last byte of the data
+	current_bit = len(data) * 8 % 6
 	out = BASE64_CHARS[(current_bit - 1) % 8 + 1] + out
 	
 	return out
 
 def decode_base64(data):
-	out = bytearray()
-	current_byte = 0
-	current_bit = 0
-	bits_in_last_byte = -1
+	if len(data) < 2:
+		return b""
 	
-	for i in range(len(data)):
-		cn = 0
-		for j in range(64):
-			if BASE64_CHARS[j] == data[i]:
-				cn = j
-				break
-		if bits_in_last_byte == -1:
-			bits_in_last_byte = cn
-		else:
-			for j in range(6):
-				if i == len(data) - 1 and j == bits_in_last_byte:
-					break
-				n = (cn & (1 << j)) >> j
-				current_byte += n << current_bit
-				current_bit += 1
-				if current_bit == 8:
-					out.append(current_byte)
-					current_byte = 0
-					current_bit = 0
+	bits_in_last_byte = min(BASE64_VALUES.get(data[0], 0), 6)
+	data = data[1:]
+	# drop the bits past the end of the data
+	if bits_in_last_byte < 6:
+		data = data[:-1] + BASE64_CHARS[BASE64_VALUES.get(data[-1], 0) & ((1 << bits_in_last_byte) - 1)]
+	out = base64.b64decode(data.translate(BASE64_DECODE_TABLE) + "A" * (-len(data) % 4)).translate(BYTE_BITS_REVERSED)
 	
-	if current_bit > 0:
-		out.append(current_byte)
+	return out[:int(((len(data) - 1) * 6 + bits_in_last_byte + 7) / 8)]
+
+def build_suffix_array(data):
+	n = len(data)
+	sa = list(range(n))
+	if n == 0:
+		return sa
+	# prefix doubling: sort suffixes by their first k characters, doubling k until all ranks are distinct
+	rank = [ord(c) for c in data]
+	k = 1
+	while True:
+		keys = [(rank[i], rank[i + k] if i + k < n else -1) for i in range(n)]
+		sa.sort(key=lambda i: keys[i])
+		new_rank = [0] * n
+		for j in range(1, n):
+			new_rank[sa[j]] = new_rank[sa[j - 1]] + (keys[sa[j - 1]] != keys[sa[j]])
+		rank = new_rank
+		if rank[sa[-1]] == n - 1:
+			break
+		k *= 2
 	
-	return bytes(out)
+	return sa
 
-def compress_base64(data, orig_data = ""):
-	if orig_data == "":
-		orig_data = data
-	
-	best_result = ""
-	best_save = 0
-	
-	for length in range(int(len(data) / 2), 0, -1):
-	#for length in range(1, int(len(data) / 2)):
-		for offset in range(len(data) - length * 2 + 1):
-			base = data[offset:offset+length] # we're essentially iterating over all bases that can be repeated at least one more time right afterwards
-			# skip this iteration if the base can be further split
-			skip = False
-			for i in range(2, int(len(base) / 2) + 1):
-				if len(base) % i == 0 and base[:i] * int(len(base) / i) == base:
-					skip = True
-					break
-			if skip:
-				continue
-			# skip this iteration if the base is already a part of a loop
-			if (offset >= length and base == data[offset-length:offset]):
+def build_lcp_array(data, sa, rank):
+	# Kasai's algorithm; lcp[i] is the common prefix length of the suffixes sa[i - 1] and sa[i]
+	n = len(data)
+	lcp = [0] * n
+	h = 0
+	for i in range(n):
+		if rank[i] == 0:
+			h = 0
+			continue
+		j = sa[rank[i] - 1]
+		while i + h < n and j + h < n and data[i + h] == data[j + h]:
+			h += 1
+		lcp[rank[i]] = h
+		if h > 0:
+			h -= 1
+	
+	return lcp
+
+def build_lce_index(data):
+	sa = build_suffix_array(data)
+	rank = [0] * len(data)
+	for i in range(len(sa)):
+		rank[sa[i]] = i
+	# sparse table over the LCP array, so that any range minimum can be looked up in O(1)
+	table = [build_lcp_array(data, sa, rank)]
+	step = 1
+	while step * 2 <= len(data):
+		prev = table[-1]
+		table.append([min(prev[i], prev[i + step]) for i in range(len(prev) - step)])
+		step *= 2
+	
+	return {"length": len(data), "rank": rank, "table": table}
+
+def query_lce(index, i, j):
+	# length of the longest common prefix of the suffixes starting at i and j
+	if i >= index["length"] or j >= index["length"]:
+		return 0
+	if i == j:
+		return index["length"] - i
+	a = index["rank"][i]
+	b = index["rank"][j]
+	if a > b:
+		a, b = b, a
+	level = (b - a).bit_length() - 1
+	row = index["table"][level]
+	return min(row[a + 1], row[b - (1 << level) + 1])
+
+def is_primitive_base(base):
+	# true if the base is not itself a smaller base repeated several times
+	return (base + base).find(base, 1) == len(base)
+
+def find_runs(data):
+	# returns (offset, length, end) of every maximal run of a primitive base repeated at least twice
+	n = len(data)
+	forward = build_lce_index(data)
+	backward = build_lce_index(data[::-1])
+	out = []
+	
+	for length in range(1, int(n / 2) + 1):
+		last_start = -1
+		# every run of two or more repeats contains a position that is a multiple of the length
+		for i in range(0, n - length, length):
+			ahead = query_lce(forward, i, i + length)
+			behind = query_lce(backward, n - i - length, n - i)
+			start = i - behind
+			end = i + length + ahead
+			if end - start < length * 2 or start == last_start:
 				continue
-			n = 1
-			while offset+length*(n+1) <= len(data) and base == data[offset+length*n:offset+length*(n+1)]:
-				n += 1
-			if n > 1:
-				result = data[:offset] + "#" + str(n) + "[" + base + "]" + data[offset+length*n:]
-				bytes_saved = len(data) - len(result)
-				if bytes_saved <= 5: # don't create more trash than it's necessary
+			last_start = start
+			if is_primitive_base(data[start:start+length]):
+				out.append((start, length, end))
+	
+	return out
+
+def compress_range(data, start, end, squares, costs, costs_key):
+	key = costs_key + data[start:end]
+	if key in compress_memo:
+		compress_memo.move_to_end(key)
+		return compress_memo[key]
+	
+	# best[i - start] is the cheapest encoding of data[i:end] and best_cost[i - start] its cost, built from right to left
+	best = [""] * (end - start + 1)
+	best_cost = [0] * (end - start + 1)
+	repeat_cost = costs["#"] + costs["["] + costs["]"]
+	min_cost = min(costs.values())
+	candidates = 0
+	for i in range(end - 1, start - 1, -1):
+		result = data[i] + best[i + 1 - start]
+		result_cost = costs[data[i]] + best_cost[i + 1 - start]
+		for length, max_n in squares[i]:
+			base = None
+			for n in range(2, min(max_n, int((end - i) / length)) + 1):
+				rest_cost = best_cost[i + length * n - start]
+				overhead = repeat_cost + sum([costs[digit] for digit in str(n)])
+				if overhead + min_cost + rest_cost >= result_cost: # can't beat the current result even with a 1-character base
 					continue
-				bytes_saved_total = len(orig_data) - len(result)
-				#print("Substring " + base + " repeats " + str(n) + " times")
-				#print("Compression result: " + result)
-				#print("Bytes saved: " + str(bytes_saved) + " (total: " + str(bytes_saved_total) + ")")
-				if bytes_saved_total > best_save:
-					best_result = compress_base64(result, orig_data)
-					best_save = bytes_saved_total
-					#print("New best save! " + str(best_save))
-	
-	if best_result == "": # the algorithm didn't find a way to shorten the code
-		return data
-	else:
-		return best_result
+				if base == None:
+					base, base_cost = compress_range(data, i, i + length, squares, costs, costs_key)
+				candidates += 1
+				if overhead + base_cost + rest_cost < result_cost:
+					result = "#" + str(n) + "[" + base + "]" + best[i + length * n - start]
+					result_cost = overhead + base_cost + rest_cost
+		best[i - start] = result
+		best_cost[i - start] = result_cost
+	
+	add_counter("compress_candidates", candidates)
+	compress_memo[key] = (best[0], best_cost[0])
+	if len(compress_memo) > COMPRESS_MEMO_SIZE:
+		compress_memo.popitem(last = False)
+	return compress_memo[key]
+
+def get_symbol_costs(lengths):
+	# the costs for compress_base64 which make it minimize the size after Huffman coding with these code lengths
+	# symbols without a code are made a bit longer than the longest code, since a new code would have to be found for them
+	costs = {symbol: lengths[symbol] for symbol in lengths}
+	missing_cost = max(lengths.values()) + 1 if len(lengths) > 0 else 1
+	for symbol in COMPRESS_SYMBOLS:
+		if not symbol in costs:
+			costs[symbol] = missing_cost
+	return costs
+
+def get_costs_key(costs):
+	# identifies the costs in the keys of the memo and the cache, the default costs have an empty key
+	if costs == None:
+		return ""
+	return "".join([symbol + str(costs[symbol]) for symbol in sorted(costs)]) + "\0"
+
+def compress_base64(data, costs = None):
+	# costs maps every symbol to its cost (see get_symbol_costs), the result is the cheapest encoding; by default it's the shortest one
+	costs_key = get_costs_key(costs)
+	if costs == None:
+		costs = UNIT_COSTS
+	
+	# squares[i] lists (length, max_n) for every base that repeats at least twice starting at position i
+	squares = [[] for i in range(len(data))]
+	for offset, length, end in find_runs(data):
+		for i in range(offset, end - length * 2 + 1):
+			squares[i].append((length, int((end - i) / length)))
+	
+	return compress_range(data, 0, len(data), squares, costs, costs_key)[0]
+
+def compress_job(data, costs):
+	# compress_base64 in a worker process; the counters of the work done there are sent back with the result
+	profile_counters.clear()
+	return compress_base64(data, costs), dict(profile_counters)
+
+class CompressCache:
+	# compress_base64 results kept on disk between runs, keyed by a hash of the input, the costs and the compressor version
+	# the file is an SQLite database, so several converters can share it at once
+	def __init__(self, path, max_size = COMPRESS_CACHE_SIZE):
+		self.max_size = max_size
+		self.db = sqlite3.connect(path, timeout = 60)
+		self.db.execute("PRAGMA journal_mode = WAL") # readers don't wait for writers
+		with self.db:
+			self.db.execute("CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, result TEXT NOT NULL, last_used INTEGER NOT NULL)")
+			self.db.execute("CREATE INDEX IF NOT EXISTS entries_last_used ON entries (last_used)")
+	
+	def get_key(self, data, costs = None):
+		return hashlib.sha256((COMPRESS_VERSION + "\0" + get_costs_key(costs) + data).encode()).hexdigest()
+	
+	def get(self, data, costs = None):
+		key = self.get_key(data, costs)
+		row = self.db.execute("SELECT result FROM entries WHERE key = ?", (key,)).fetchone()
+		if row == None:
+			return None
+		with self.db:
+			self.db.execute("UPDATE entries SET last_used = ? WHERE key = ?", (time.time_ns(), key))
+		return row[0]
+	
+	def put(self, data, result, costs = None):
+		with self.db:
+			self.db.execute("INSERT OR REPLACE INTO entries VALUES (?, ?, ?)", (self.get_key(data, costs), result, time.time_ns()))
+	
+	def compress(self, data, costs = None):
+		result = self.get(data, costs)
+		if result == None:
+			result = compress_base64(data, costs)
+			self.put(data, result, costs)
+		return result
+	
+	def compress_all(self, data, jobs = 1, costs = None):
+		# compresses a list of strings; the ones missing from the cache are split between several processes if jobs > 1
+		# the results come back in the same order as the input, so the output doesn't depend on the amount of jobs
+		results = [self.get(item, costs) for item in data]
+		missing = [i for i in range(len(data)) if results[i] == None]
+		if jobs > 1 and len(missing) > 1:
+			compressed = []
+			with ProcessPoolExecutor(jobs) as executor:
+				for result, counters in executor.map(compress_job, [data[i] for i in missing], [costs] * len(missing)):
+					compressed.append(result)
+					for name in counters:
+						add_counter(name, counters[name])
+		else:
+			compressed = [compress_base64(data[i], costs) for i in missing]
+		for i, result in zip(missing, compressed):
+			results[i] = result
+			self.put(data[i], result, costs)
+		add_counter("compress_cache_hits", len(data) - len(missing))
+		
+		return results
+	
+	def close(self):
+		# evict the least recently used entries until the stored results fit in the size limit
+		with self.db:
+			size = 0
+			for key, length in self.db.execute("SELECT key, LENGTH(result) FROM entries ORDER BY last_used DESC").fetchall():
+				size += length
+				if size > self.max_size:
+					self.db.execute("DELETE FROM entries WHERE key = ?", (key,))
+		self.db.close()
 
 def decompress_base64(data):
 	buffer = [""]
@@ -205,45 +555,124 @@ def count_bytes(data):
 	
 	return out
 
-def generate_huffman_tree(weights):
-	entries = []
+def generate_huffman_lengths(weights):
+	lengths = {}
+	if len(weights) == 1: # a lone symbol still needs one bit
+		for value in weights:
+			lengths[value] = 1
+		return lengths
+	
+	# generate Huffman tree; leaves are nodes 0..n-1, every merge appends a new node which becomes the parent of both merged ones
+	values = list(weights)
+	parents = [0] * len(values)
+	heap = []
+	for i in range(len(values)):
+		heap.append((weights[values[i]], i))
+	heapq.heapify(heap)
+	while len(heap) > 1:
+		weight1, node1 = heapq.heappop(heap) # lowest entry
+		weight2, node2 = heapq.heappop(heap) # second lowest entry
+		parents[node1] = len(parents)
+		parents[node2] = len(parents)
+		parents.append(0)
+		heapq.heappush(heap, (weight1 + weight2, len(parents) - 1))
+	
+	# parents always come after their children, so the depths can be resolved from the root down
+	depths = [0] * len(parents)
+	for i in range(len(parents) - 2, -1, -1):
+		depths[i] = depths[parents[i]] + 1
+	for i in range(len(values)):
+		lengths[values[i]] = depths[i]
+	
+	return lengths
+
+def get_canonical_huffman_order(lengths):
+	return sorted(lengths, key = lambda value: (lengths[value], value))
+
+def generate_canonical_huffman_codes(lengths):
+	# the codes are fully determined by their lengths: consecutive numbers in canonical order, shifted left whenever the length grows
 	mappings = {}
-	for value in weights:
-		entries.append({"value": value, "weight": weights[value]})
-		mappings[value] = ""
-	
-	# generate Huffman tree
-	while len(entries) > 1:
-		entry1 = None # lowest entry
-		entry2 = None # second lowest entry
-		for entry in entries:
-			if entry1 == None or entry["weight"] < entry1["weight"]:
-				entry1 = entry
-		for entry in entries:
-			if (entry2 == None or entry["weight"] < entry2["weight"]) and entry != entry1:
-				entry2 = entry
-		# entries found, map bits
-		update_huffman_mapping(mappings, entry1["value"], "0")
-		update_huffman_mapping(mappings, entry2["value"], "1")
-		# update the tree
-		entries.append({"value": [entry1["value"], entry2["value"]], "weight": entry1["weight"] + entry2["weight"]})
-		del entries[entries.index(entry1)]
-		del entries[entries.index(entry2)]
+	code = 0
+	prev_length = 0
+	for value in get_canonical_huffman_order(lengths):
+		code <<= lengths[value] - prev_length
+		prev_length = lengths[value]
+		mappings[value] = format(code, "0" + str(prev_length) + "b")
+		code += 1
 	
 	return mappings
 
-def update_huffman_mapping(mappings, value, bit):
-	if type(value) is list:
-		update_huffman_mapping(mappings, value[0], bit)
-		update_huffman_mapping(mappings, value[1], bit)
-	else:
-		mappings[value] = bit + mappings[value]
+def get_huffman_size(data, lengths):
+	# how long the strings get after compress_huffman and encode_base64 with the canonical codes of these lengths
+	size = 0
+	for item in data:
+		data_bytes = int((sum([lengths[byte] for byte in item]) + 7) / 8) + 1 # with the byte of meaningful bits in front
+		size += int((data_bytes * 8 + 5) / 6) + 1 # with the character of meaningful bits in front
+	
+	return size
+
+def recompress_for_huffman(tests, compressed, changed, compress_all):
+	# the shortest strings don't always give the smallest Huffman coded ones, so the changed ones (indexes in tests) are compressed again
+	# with the lengths of the last Huffman code as the costs of the symbols, for as long as the coded size goes down
+	# compress_all(data, costs) compresses a list of strings; returns the compressed strings and their Huffman code lengths
+	lengths = generate_huffman_lengths(count_bytes("".join(compressed)))
+	coded_size = get_huffman_size(compressed, lengths)
+	for i in range(COMPRESS_ROUNDS if len(changed) > 0 else 0):
+		candidate = list(compressed)
+		for j, result in zip(changed, compress_all([tests[j] for j in changed], get_symbol_costs(lengths))):
+			candidate[j] = result
+		candidate_lengths = generate_huffman_lengths(count_bytes("".join(candidate)))
+		size = get_huffman_size(candidate, candidate_lengths)
+		logger.debug("Compression round %s: %s bytes after Huffman coding", i + 1, size)
+		if size >= coded_size:
+			break
+		compressed = candidate
+		coded_size = size
+		if candidate_lengths == lengths: # the next round would have the same costs
+			break
+		lengths = candidate_lengths
+	
+	return compressed, generate_huffman_lengths(count_bytes("".join(compressed)))
 
-def invert_huffman_mapping(mapping):
-	inverse_mapping = {}
-	for byte in mapping:
-		inverse_mapping[mapping[byte]] = byte
-	return inverse_mapping
+def serialize_huffman_tree(mapping):
+	# the codes as nested tables {zero, one} whose leaves are the symbols, which the humdec function of the cart walks bit by bit
+	tree = [None, None]
+	for value in mapping:
+		table = tree
+		code = mapping[value]
+		for bit in code[:-1]:
+			if table[int(bit)] == None:
+				table[int(bit)] = [None, None]
+			table = table[int(bit)]
+		table[int(code[-1])] = value.translate(CART_BRACKETS)
+	
+	return str(tree).replace("[", "{").replace("]", "}").replace(", ", ",").replace("'", "\"").replace("None", "nil")
+
+def deserialize_huffman_tree(data):
+	# inverse of serialize_huffman_tree, returns the codes of the symbols; the code grows a bit on every opened table
+	# and its last bit becomes a one after the comma
+	mapping = {}
+	code = ""
+	i = 0
+	while i < len(data):
+		char = data[i]
+		if char == "{":
+			code += "0"
+		elif char == ",":
+			code = code[:-1] + "1"
+		elif char == "}":
+			code = code[:-1]
+		elif char == "\"":
+			end = data.index("\"", i + 1)
+			mapping[data[i+1:end].translate(CONVERTER_BRACKETS)] = code
+			i = end
+		elif data.startswith("nil", i):
+			i += 2
+		else:
+			raise ValueError("Unexpected character in the Huffman tree: " + char)
+		i += 1
+	
+	return mapping
 
 def compress_huffman(data, mapping):
 	out = bytearray()
@@ -267,99 +696,168 @@ def compress_huffman(data, mapping):
 	
 	return bytes(out)
 
-def decompress_huffman(data, inverse_mapping):
-	out = ""
-	current_byte = ""
-	bits_in_last_byte = -1
-	
-	for i in range(len(data)):
-		byte = data[i]
-		if bits_in_last_byte == -1:
-			bits_in_last_byte = byte
+def build_huffman_lookup(mapping):
+	# returns (bits, table); the table is indexed by the next bits of the stream (the first one being the lowest bit)
+	# and holds (value, code length), or (None, (bits, table)) of a subtable for codes longer than the table's bits
+	bits = min(max(len(code) for code in mapping.values()), HUFFMAN_LOOKUP_BITS)
+	table = [None] * (1 << bits)
+	long_codes = {}
+	
+	for value in mapping:
+		code = mapping[value]
+		if type(value) is str:
+			value = ord(value)
+		index = int(code[:bits][::-1], 2)
+		if len(code) <= bits:
+			for high in range(1 << (bits - len(code))):
+				table[index + (high << len(code))] = (value, len(code))
 		else:
-			for j in range(8):
-				if i == len(data) - 1 and j == bits_in_last_byte:
-					break
-				bit = (byte & (1 << j)) >> j
-				current_byte += str(bit)
-				if current_byte in inverse_mapping:
-					out += inverse_mapping[current_byte]
-					current_byte = ""
+			if not index in long_codes:
+				long_codes[index] = {}
+			long_codes[index][value] = code[bits:]
+	for index in long_codes:
+		table[index] = (None, build_huffman_lookup(long_codes[index]))
 	
-	return out
-
-
+	return (bits, table)
 
-def read_bytes(data, bytes, big_endian = False):
-	global read_ptr
+def decompress_huffman(data, lookup):
+	out = bytearray()
+	# the first byte of the data indicates how many bits are meaningful in the last byte of the data
+	bits_left = max(len(data) - 2, 0) * 8 + data[0] if len(data) > 1 else 0
+	buffer = 0
+	buffer_bits = 0
+	read_pos = 1
+	
+	while bits_left > 0:
+		bits, table = lookup
+		while True:
+			# refilled before every lookup, since a long code goes through several subtables
+			while buffer_bits <= 32 and read_pos < len(data):
+				buffer += data[read_pos] << buffer_bits
+				buffer_bits += 8
+				read_pos += 1
+			entry = table[buffer & ((1 << bits) - 1)]
+			if entry == None: # not a valid code, the data is broken
+				return bytes(out)
+			if entry[0] != None:
+				break
+			buffer >>= bits
+			buffer_bits -= bits
+			bits_left -= bits
+			bits, table = entry[1]
+		out.append(entry[0])
+		buffer >>= entry[1]
+		buffer_bits -= entry[1]
+		bits_left -= entry[1]
 	
-	out = data[read_ptr:read_ptr+bytes]
-	read_ptr += bytes
-	if big_endian:
-		out = out[::-1]
-	return out
+	return bytes(out)
 
-def read_int(data, bytes):
-	bytes = read_bytes(data, bytes, True)
-	num = 0
-	for b in bytes:
-		num = (num << 8) + b
-	return num
+def shorten_base64(data):
+	return data.replace("AAAI", "@").replace("IAA", "$").replace("IAQh", "%").replace("Ago", "^")
 
-def read_ints(data, bytes, count):
-	out = []
-	for i in range(count):
-		out.append(read_int(data, bytes))
-	return out
+def expand_base64(data):
+	return data.replace("@", "AAAI").replace("$", "IAA").replace("%", "IAQh").replace("^", "Ago")
 
-def read_float4(data):
-	bytes = read_bytes(data, 4, True)
-	return struct.unpack(">f", bytes)[0]
 
-def read_string(data):
-	out = b""
-	while len(out) == 0 or out[-1] != 0:
-		out += read_bytes(data, 1)
-	return out[:-1]
 
-def read_strings(data, count):
-	out = []
-	for i in range(count):
-		out.append(read_string(data))
-	return out
+INT_STRUCTS = {1: struct.Struct("<B"), 2: struct.Struct("<H"), 4: struct.Struct("<I")}
+FLOAT4_STRUCT = struct.Struct("<f")
 
+class Reader:
+	# a cursor over the data; every parsing function makes its own, so several modules can be parsed at once
+	def __init__(self, data, ptr = 0):
+		self.view = memoryview(data)
+		self.ptr = ptr
+	
+	def read_view(self, size):
+		out = self.view[self.ptr:self.ptr+size]
+		self.ptr += size
+		return out
+	
+	def read_bytes(self, size):
+		return self.read_view(size).tobytes()
+	
+	def read_int(self, size):
+		num = INT_STRUCTS[size].unpack_from(self.view, self.ptr)[0]
+		self.ptr += size
+		return num
+	
+	def read_ints(self, size, count):
+		out = list(struct.unpack_from("<" + str(count) + INT_STRUCTS[size].format[1:], self.view, self.ptr))
+		self.ptr += size * count
+		return out
+	
+	def read_array(self, typecode, count):
+		out = array(typecode)
+		out.frombytes(self.read_view(out.itemsize * count))
+		if sys.byteorder == "big":
+			out.byteswap()
+		return out
+	
+	def read_float4(self):
+		num = FLOAT4_STRUCT.unpack_from(self.view, self.ptr)[0]
+		self.ptr += 4
+		return num
+	
+	def read_string(self):
+		# the end is searched for in the view itself, which can be a slice of a bigger object; a few bytes at a time, since strings are short
+		end = -1
+		searched = self.ptr
+		size = STRING_SEARCH_SIZE
+		while end == -1 and searched < len(self.view):
+			end = self.view[searched:searched+size].tobytes().find(b"\0")
+			if end != -1:
+				end += searched
+			searched += size
+			size *= 2
+		if end == -1:
+			raise ValueError("String at " + str(self.ptr) + " has no end")
+		out = self.view[self.ptr:end].tobytes()
+		self.ptr = end + 1
+		return out
+	
+	def read_strings(self, count):
+		out = []
+		for i in range(count):
+			out.append(self.read_string())
+		return out
 
 
-def format_pattern_row(row):
+
+def format_pattern_row(pattern, j):
 	s = ""
+	note = pattern["notes"][j]
+	octave = pattern["octaves"][j]
+	instrument = pattern["instruments"][j]
+	volume = pattern["volumes"][j]
 	
-	if row["note"] == 0 and row["octave"] == 0:
+	if note == 0 and octave == 0:
 		s += "--- "
 	else:
-		if row["note"] <= 12:
-			s += NOTE_PREFIXES[row["note"]] + str(row["octave"]) + " "
-		elif row["note"] >= 100:
+		if note <= 12:
+			s += NOTE_PREFIXES[note] + str(octave) + " "
+		elif note >= 100:
 			s += "^^  "
 		else:
 			s += "XXX "
 	
-	if row["instrument"] == 65535:
+	if instrument == 65535:
 		s += "-- "
 	else:
-		if row["instrument"] < 10:
+		if instrument < 10:
 			s += "0"
-		s += str(row["instrument"]) + " "
+		s += str(instrument) + " "
 	
-	if row["volume"] == 65535:
+	if volume == 65535:
 		s += "-- "
 	else:
-		if row["volume"] < 10:
+		if volume < 10:
 			s += "0"
-		s += str(row["volume"]) + " "
+		s += str(volume) + " "
 	
-	for i in range(len(row["effects"])):
-		effect = row["effects"][i]
-		effect_d = row["effect_data"][i]
+	for i in range(len(pattern["effects"])):
+		effect = pattern["effects"][i][j]
+		effect_d = pattern["effect_data"][i][j]
 		if effect == 65535:
 			s += "--"
 		else:
@@ -379,70 +877,66 @@ def format_pattern_row(row):
 
 
 def get_wavetable(data, ptr):
-	global read_ptr
-	
-	read_ptr = ptr
+	reader = Reader(data, ptr)
 	
-	if read_bytes(data, 4) != b"WAVE":
-		print("WAVE block not found correctly!")
+	if reader.read_bytes(4) != b"WAVE":
+		logger.error("WAVE block not found correctly!")
 		return
 	
 	out = {}
 	
-	print("WAVE block size: " + str(read_int(data, 4)))
-	out["name"] = read_string(data)
-	out["width"] = read_int(data, 4)
-	read_ptr += 4
-	out["height"] = read_int(data, 4)
-	out["data"] = read_ints(data, 4, out["width"])
+	logger.debug("WAVE block size: %s", reader.read_int(4))
+	out["name"] = reader.read_string()
+	out["width"] = reader.read_int(4)
+	reader.ptr += 4
+	out["height"] = reader.read_int(4)
+	out["data"] = reader.read_ints(4, out["width"])
 	
 	return out
 
 
 
 def get_instrument(data, ptr):
-	global read_ptr
-	
-	read_ptr = ptr
+	reader = Reader(data, ptr)
 	
-	if read_bytes(data, 4) != b"INS2":
-		print("INS2 block not found correctly!")
+	if reader.read_bytes(4) != b"INS2":
+		logger.error("INS2 block not found correctly!")
 		return
 	
 	out = {}
 	
-	print("INS2 block size: " + str(read_int(data, 4)))
-	out["version"] = read_int(data, 2)
-	out["type"] = read_int(data, 2)
+	logger.debug("INS2 block size: %s", reader.read_int(4))
+	out["version"] = reader.read_int(2)
+	out["type"] = reader.read_int(2)
 	while True:
-		feature_code = read_bytes(data, 2)
+		feature_code = reader.read_bytes(2)
 		#print("Feature code: " + str(feature_code))
 		if feature_code == b"EN":
 			break
-		block_length = read_int(data, 2)
+		block_length = reader.read_int(2)
 		#print("Block length: " + str(block_length))
 		if feature_code == b"NA":
-			out["name"] = read_string(data)
+			out["name"] = reader.read_string()
 		elif feature_code == b"MA":
-			macro_header_length = read_int(data, 2)
+			macro_header_length = reader.read_int(2)
 			#print("Macro header length: " + str(macro_header_length))
 			while True:
 				macro = {}
-				macro["code"] = read_int(data, 1)
+				macro["code"] = reader.read_int(1)
 				if macro["code"] == 255:
 					break
-				macro["length"] = read_int(data, 1)
-				macro["loop"] = read_int(data, 1)
-				macro["release"] = read_int(data, 1)
-				macro["mode"] = read_int(data, 1)
-				macro_otw = read_int(data, 1)
+				macro["length"] = reader.read_int(1)
+				macro["loop"] = reader.read_int(1)
+				macro["release"] = reader.read_int(1)
+				macro["mode"] = reader.read_int(1)
+				macro_otw = reader.read_int(1)
 				macro["word_size"] = (macro_otw & 192) >> 6
 				if macro["word_size"] == 0 or macro["word_size"] == 3:
 					macro["word_size"] += 1
 				macro["type"] = (macro_otw & 6) >> 1
-				macro["delay"] = read_int(data, 1)
-				macro["speed"] = read_int(data, 1)
-				macro["data"] = read_bytes(data, macro["length"] * macro["word_size"])
+				macro["delay"] = reader.read_int(1)
+				macro["speed"] = reader.read_int(1)
+				macro["data"] = reader.read_bytes(macro["length"] * macro["word_size"])
 				if macro["code"] == 0:
 					out["volume"] = macro
 				elif macro["code"] == 1:
@@ -454,10 +948,10 @@ def get_instrument(data, ptr):
 				elif macro["code"] == 4:
 					out["pitch"] = macro
 				else:
-					print("Unsupported macro code: " + str(macro["code"]) + " Implement me!")
+					logger.error("Unsupported macro code: %s Implement me!", macro["code"])
 					return
 		else:
-			print("Unsupported feature_code: " + str(feature_code) + " Implement me!")
+			logger.error("Unsupported feature_code: %s Implement me!", feature_code)
 			return
 	
 	return out
@@ -465,40 +959,260 @@ def get_instrument(data, ptr):
 
 
 def get_pattern(data, ptr, pattern_length, effect_columns):
-	global read_ptr
+	reader = Reader(data, ptr)
 	
-	read_ptr = ptr
+	if reader.read_bytes(4) != b"PATR":
+		logger.error("PATR block not found correctly!")
+		return
+	
+	out = {}
 	
-	if read_bytes(data, 4) != b"PATR":
-		print("PATR block not found correctly!")
+	logger.debug("PATR block size: %s", reader.read_int(4))
+	out["channel"] = reader.read_int(2)
+	out["index"] = reader.read_int(2)
+	out["subsong"] = reader.read_int(2)
+	reader.ptr += 2
+	# the rows are a fixed-stride array of little-endian uint16: note, octave, instrument, volume, then effect and value pairs
+	# they're kept as one array per column, which the converter and format_pattern_row read by the row number
+	stride = 4 + effect_columns[out["channel"]] * 2
+	values = reader.read_array("H", pattern_length * stride)
+	out["notes"] = values[0::stride]
+	out["octaves"] = array("H", [octave + (note == 12) for note, octave in zip(out["notes"], values[1::stride])])
+	out["instruments"] = values[2::stride]
+	out["volumes"] = values[3::stride]
+	out["effects"] = [values[4+k*2::stride] for k in range(effect_columns[out["channel"]])]
+	out["effect_data"] = [values[5+k*2::stride] for k in range(effect_columns[out["channel"]])]
+	#for j in range(pattern_length):
+	#	logger.debug("%s   %s", j, format_pattern_row(out, j))
+	logger.debug("Channel: %s", out["channel"])
+	logger.debug("Index: %s", out["index"])
+	out["name"] = reader.read_string()
+	
+	return out
+
+
+
+def get_song_info(data):
+	reader = Reader(data)
+	
+	if reader.read_bytes(16) != b"-Furnace module-":
+		logger.error("It's not a valid file or the decompression went wrong!")
+		return
+	
+	logger.debug("Version number: %s", reader.read_int(2))
+	reader.ptr += 2
+	song_info_ptr = reader.read_int(4)
+	reader.ptr = song_info_ptr
+	
+	if reader.read_bytes(4) != b"INFO":
+		logger.error("INFO block not found correctly!")
 		return
 	
 	out = {}
 	
-	print("PATR block size: " + str(read_int(data, 4)))
-	out["channel"] = read_int(data, 2)
-	out["index"] = read_int(data, 2)
-	out["subsong"] = read_int(data, 2)
-	read_ptr += 2
-	out["rows"] = []
-	for j in range(pattern_length):
-		row = {}
-		row["note"] = read_int(data, 2)
-		row["octave"] = read_int(data, 2)
-		if row["note"] == 12:
-			row["octave"] += 1
-		row["instrument"] = read_int(data, 2)
-		row["volume"] = read_int(data, 2)
-		row["effects"] = []
-		row["effect_data"] = []
-		for k in range(effect_columns[out["channel"]]):
-			row["effects"].append(read_int(data, 2))
-			row["effect_data"].append(read_int(data, 2))
-		#print(str(j) + "   " + format_pattern_row(row))
-		out["rows"].append(row)
-	print("Channel: " + str(out["channel"]))
-	print("Index: " + str(out["index"]))
-	out["name"] = read_string(data)
+	logger.debug("=========== INFO block size: %s", reader.read_int(4))
+	logger.debug("Time base: %s", reader.read_int(1))
+	logger.debug("Speed 1: %s", reader.read_int(1))
+	logger.debug("Speed 2: %s", reader.read_int(1))
+	logger.debug("Initial arp time: %s", reader.read_int(1))
+	logger.debug("Ticks per second: %s", reader.read_float4())
+	out["pattern_length"] = reader.read_int(2)
+	logger.debug("Pattern length: %s", out["pattern_length"])
+	out["orders_length"] = reader.read_int(2)
+	logger.debug("Orders length: %s", out["orders_length"])
+	logger.debug("Highlight A: %s", reader.read_int(1))
+	logger.debug("Highlight B: %s", reader.read_int(1))
+	
+	out["instrument_count"] = reader.read_int(2)
+	logger.debug("Instrument count: %s", out["instrument_count"])
+	out["wavetable_count"] = reader.read_int(2)
+	logger.debug("Wavetable count: %s", out["wavetable_count"])
+	out["sample_count"] = reader.read_int(2)
+	logger.debug("Sample count: %s", out["sample_count"])
+	out["pattern_count"] = reader.read_int(4)
+	logger.debug("Pattern count: %s", out["pattern_count"])
+	
+	logger.debug("Sound chips:")
+	soundchip_bytes = reader.read_bytes(32)
+	for b in soundchip_bytes:
+		if b == 0:
+			break
+		else:
+			logger.debug("%s", b)
+	soundchip_volumes = reader.read_bytes(32)
+	soundchip_panning = reader.read_bytes(32)
+	soundchip_flagptrs = reader.read_bytes(128)
+	
+	logger.debug("Song name: %s", reader.read_string())
+	logger.debug("Song author: %s", reader.read_string())
+	logger.debug("A-4 tuning: %s", reader.read_float4())
+	logger.debug("Limit slides: %s", reader.read_int(1))
+	logger.debug("Linear pitch: %s", reader.read_int(1))
+	logger.debug("Loop modality: %s", reader.read_int(1))
+	logger.debug("Proper noise layout: %s", reader.read_int(1))
+	logger.debug("Wave duty is volume: %s", reader.read_int(1))
+	logger.debug("Reset macro on porta: %s", reader.read_int(1))
+	logger.debug("Legacy volume slides: %s", reader.read_int(1))
+	logger.debug("Compatible arpeggio: %s", reader.read_int(1))
+	logger.debug("Note off resets slides: %s", reader.read_int(1))
+	logger.debug("Target resets slides: %s", reader.read_int(1))
+	logger.debug("Arpeggio inhibits portamento: %s", reader.read_int(1))
+	logger.debug("Wack algorithm macro: %s", reader.read_int(1))
+	logger.debug("Broken shortcut slides: %s", reader.read_int(1))
+	logger.debug("Ignore duplicate slides: %s", reader.read_int(1))
+	logger.debug("Stop portamento on note off: %s", reader.read_int(1))
+	logger.debug("Continuous vibrato: %s", reader.read_int(1))
+	logger.debug("Broken DAC mode: %s", reader.read_int(1))
+	logger.debug("One tick cut: %s", reader.read_int(1))
+	logger.debug("Instrument change allowed during porta: %s", reader.read_int(1))
+	logger.debug("Reset note base on arpeggio effect stop: %s", reader.read_int(1))
+	
+	out["instrument_ptrs"] = reader.read_ints(4, out["instrument_count"])
+	logger.debug("Instrument pointers: %s", out["instrument_ptrs"])
+	out["wavetable_ptrs"] = reader.read_ints(4, out["wavetable_count"])
+	logger.debug("Wavetable pointers: %s", out["wavetable_ptrs"])
+	out["sample_ptrs"] = reader.read_ints(4, out["sample_count"])
+	logger.debug("Sample pointers: %s", out["sample_ptrs"])
+	out["pattern_ptrs"] = reader.read_ints(4, out["pattern_count"])
+	logger.debug("Pattern pointers: %s", out["pattern_ptrs"])
+	
+	out["orders"] = reader.read_bytes(CHANNEL_COUNT * out["orders_length"])
+	logger.debug("Orders: %s", out["orders"])
+	out["effect_columns"] = reader.read_bytes(CHANNEL_COUNT)
+	logger.debug("Effect columns: %s", out["effect_columns"])
+	channel_hide_status = reader.read_bytes(CHANNEL_COUNT)
+	channel_collapse_status = reader.read_bytes(CHANNEL_COUNT)
+	logger.debug("Channel names: %s", reader.read_strings(CHANNEL_COUNT))
+	logger.debug("Channel short names: %s", reader.read_strings(CHANNEL_COUNT))
+	logger.debug("Song comment: %s", reader.read_string())
+	logger.debug("Master volume: %s", reader.read_float4())
+	logger.debug("Extended compatibility flags: %s", reader.read_bytes(28))
+	logger.debug("Virtual tempo numerator: %s", reader.read_int(2))
+	logger.debug("Virtual tempo denominator: %s", reader.read_int(2))
+	logger.debug("First subsong name: %s", reader.read_string())
+	logger.debug("First subsong comment: %s", reader.read_string())
+	subsong_count = reader.read_int(1)
+	logger.debug("Subsong count: %s", subsong_count)
+	reader.ptr += 3
+	subsong_ptrs = reader.read_ints(4, subsong_count)
+	logger.debug("Subsong pointers: %s", subsong_ptrs)
+	logger.debug("System name: %s", reader.read_string())
+	logger.debug("Album/category/game name: %s", reader.read_string())
+	logger.debug("Song name (JP): %s", reader.read_string())
+	logger.debug("Song author (JP): %s", reader.read_string())
+	logger.debug("System name (JP): %s", reader.read_string())
+	logger.debug("Album/category/game name (JP): %s", reader.read_string())
+	logger.debug("Chip volume: %s", reader.read_float4())
+	logger.debug("Chip panning: %s", reader.read_float4())
+	logger.debug("Chip balance: %s", reader.read_float4())
+	patchbay_connection_count = reader.read_int(4)
+	patchbay_connections = reader.read_ints(4, patchbay_connection_count)
+	logger.debug("Patchbay connections: %s", patchbay_connections)
+	logger.debug("Automatic patchbay: %s", reader.read_int(1))
+	logger.debug("Broken portamento during legato: %s", reader.read_int(1))
+	reader.ptr += 7
+	logger.debug("Speed pattern speed: %s", reader.read_int(1))
+	logger.debug("Speed pattern: %s", reader.read_bytes(16))
+	logger.debug("Groove entries: %s", reader.read_int(1))
+	
+	return out
+
+
+
+class FurStream:
+	# a compressed module which is inflated only as far as the blocks read so far need it
+	def __init__(self, source):
+		self.source = memoryview(source)
+		self.source_ptr = 0
+		self.decompressor = zlib.decompressobj()
+		self.data = bytearray()
+	
+	def get(self, size):
+		# returns the data inflated so far (at least the given size, unless the data ends before that)
+		# the view must be dropped before calling this again, because the buffer can't grow while it's exported
+		while len(self.data) < size and not self.decompressor.eof and self.source_ptr < len(self.source):
+			chunk = self.decompressor.decompress(self.source[self.source_ptr:self.source_ptr+FUR_STREAM_CHUNK_SIZE])
+			add_counter("inflate_bytes_in", min(FUR_STREAM_CHUNK_SIZE, len(self.source) - self.source_ptr))
+			add_counter("inflate_bytes_out", len(chunk))
+			self.data += chunk
+			self.source_ptr += FUR_STREAM_CHUNK_SIZE
+		return memoryview(self.data)
+
+
+
+class FurModule:
+	# only the header and the pointer tables are parsed up front, instruments, wavetables and patterns are parsed on first access
+	# the data can be the whole module or a FurStream, which is then inflated only as far as the parsed blocks reach
+	# blocks parsed through a shared parse_cache are remembered by their contents, so loading the module again only parses the changes
+	def __init__(self, data, parse_cache = None):
+		self.data = data
+		self.parse_cache = parse_cache
+		self.info = None
+		self.instruments = {}
+		self.wavetables = {}
+		self.patterns = {}
+		header = self.get_data(24)
+		if header[:16] != b"-Furnace module-":
+			logger.error("It's not a valid file or the decompression went wrong!")
+			return
+		song_info_ptr = Reader(header, 20).read_int(4)
+		del header
+		self.info = get_song_info(self.get_block_data(song_info_ptr))
+	
+	def get_data(self, size):
+		if type(self.data) is FurStream:
+			return self.data.get(size)
+		return self.data
+	
+	def get_block_data(self, ptr):
+		# makes sure that the whole block at ptr is available: 4 bytes of the block ID, 4 bytes of the size and the contents
+		size = Reader(self.get_data(ptr + 8), ptr + 4).read_int(4)
+		return self.get_data(ptr + 8 + size)
+	
+	def get_block(self, ptr):
+		data = self.get_block_data(ptr)
+		return bytes(data[ptr:ptr+8+Reader(data, ptr + 4).read_int(4)])
+	
+	def parse_block(self, parser, ptr, *args):
+		if self.parse_cache == None:
+			return parser(self.get_block_data(ptr), ptr, *args)
+		block = self.get_block(ptr)
+		key = (parser.__name__, block) + args
+		if not key in self.parse_cache:
+			if len(self.parse_cache) >= PARSE_CACHE_SIZE:
+				self.parse_cache.clear()
+			self.parse_cache[key] = parser(block, 0, *args)
+		return self.parse_cache[key]
+	
+	def get_instrument(self, index):
+		if not index in self.instruments:
+			self.instruments[index] = self.parse_block(get_instrument, self.info["instrument_ptrs"][index])
+		return self.instruments[index]
+	
+	def get_wavetable(self, index):
+		if not index in self.wavetables:
+			self.wavetables[index] = self.parse_block(get_wavetable, self.info["wavetable_ptrs"][index])
+		return self.wavetables[index]
+	
+	def get_pattern(self, index):
+		if not index in self.patterns:
+			self.patterns[index] = self.parse_block(get_pattern, self.info["pattern_ptrs"][index], self.info["pattern_length"], self.info["effect_columns"])
+		return self.patterns[index]
+
+
+
+def index_patterns(patterns):
+	# maps (channel, n) to the number of the n-th pattern of that channel in the whole list
+	# and collects the patterns which end after the first half
+	out = {"patterns": {}, "jumps": set()}
+	counts = {}
+	for i in range(len(patterns)):
+		channel = patterns[i]["channel"]
+		n = counts.get(channel, 0)
+		out["patterns"][(channel, n)] = i
+		counts[channel] = n + 1
+		if patterns[i]["effects"][0][63] == 13: # is there a "jump to next pattern" command in the middle of a pattern?
+			out["jumps"].add(i)
 	
 	return out
 
@@ -509,7 +1223,7 @@ def convert_wavetable(wavetable):
 	low_nibble = True
 	
 	if len(wavetable["data"]) != 32:
-		print("Warning: wavetable " + str(wavetable["name"]) + " not 32 bytes long")
+		logger.warning("Warning: wavetable %s not 32 bytes long", wavetable["name"])
 	
 	for i in range(32):
 		n = int(wavetable["data"][int(i * wavetable["width"] / 32)] * 16 / (wavetable["height"] + 1))
@@ -524,7 +1238,7 @@ def convert_wavetable(wavetable):
 
 
 def convert_instrument(instrument):
-	print(instrument["name"])
+	logger.debug("%s", instrument["name"])
 	out = bytearray()
 	
 	for i in range(30):
@@ -578,203 +1292,178 @@ def convert_instrument(instrument):
 
 
 def convert_pattern(pattern, prev_pattern = None):
-	out = bytearray()
+	# the notes and octaves are converted column by column, and the instruments and effects, which carry state from row to row, in one pass
+	# the three bytes of every row are then interleaved into the output
+	notes = pattern["notes"]
+	instruments = pattern["instruments"]
+	effects = pattern["effects"][0] # only the first effect column is converted
+	effect_data = pattern["effect_data"][0]
 	
 	last_instrument = 0
 	slide_active = False
 	# we need more patterns in order to look at the last instrument
 	if prev_pattern != None:
-		for row in prev_pattern["rows"]:
-			if row["instrument"] != 65535:
-				last_instrument = row["instrument"]
+		for instrument in reversed(prev_pattern["instruments"]):
+			if instrument != 65535:
+				last_instrument = instrument
+				break
 	
-	for row in pattern["rows"]:
-		vals = [0, 0, 0, 0, 0, 0] # note, p1, p2, command, instrument, octave
-		
-		if row["note"] >= 100:
-			vals[0] = 1
-		elif row["note"] == 12:
-			vals[0] = 4
-		elif row["note"] != 0 and row["note"] < 12:
-			vals[0] = row["note"] + 4
-		
-		if row["instrument"] != 65535:
-			vals[4] = row["instrument"]
-			last_instrument = row["instrument"]
-		elif row["note"] > 0 and row["note"] <= 12:
-			vals[4] = last_instrument
-		
-		vals[5] = row["octave"] + 1
+	byte0 = [NOTE_VALUES[note] if note <= 12 else 1 if note >= 100 else 0 for note in notes] # note, p1
+	byte1 = [0] * len(notes) # p2, command, instrument bit 5
+	byte2 = [(octave + 1) << 5 for octave in pattern["octaves"]] # instrument bits 0-4, octave
+	
+	j = 0
+	for note, instrument, effect, data in zip(notes, instruments, effects, effect_data):
+		if instrument != 65535:
+			last_instrument = instrument
+		elif note > 0 and note <= 12:
+			instrument = last_instrument
+		else:
+			instrument = 0
 		
-		if row["effects"][0] == 0 and row["effect_data"][0] != 65535:
-			vals[3] = 2
-			vals[1] = int(row["effect_data"][0] / 16)
-			vals[2] = row["effect_data"][0] % 16
-		elif row["effects"][0] == 3:
-			vals[3] = 4
-			n = max(1, row["effect_data"][0]) * 4
-			if row["effect_data"][0] == 65535:
-				n = 4
-			vals[1] = int(n / 16)
-			vals[2] = n % 16
+		if effect == 0 and data != 65535:
+			byte0[j] += (data >> 4) << 4
+			byte1[j] = (data & 15) + (2 << 4)
+		elif effect == 3:
+			n = 4 if data == 65535 else max(1, data) * 4
+			byte0[j] += (n >> 4) << 4
+			byte1[j] = (n & 15) + (4 << 4)
 			slide_active = True
-		elif row["note"] != 0 and slide_active: # slide needs to be cancelled manually
-			vals[3] = 4
-			# params remain zero
+		elif note != 0 and slide_active: # slide needs to be cancelled manually
+			byte1[j] = 4 << 4 # params remain zero
 			slide_active = False
 		
-		out.append(vals[0] + (vals[1] << 4))
-		out.append(vals[2] + (vals[3] << 4) + ((vals[4] & 32) << 2))
-		out.append((vals[4] & 31) + (vals[5] << 5))
-	
+		byte1[j] += (instrument & 32) << 2
+		byte2[j] += instrument & 31
+		j += 1
+	
+	out = bytearray(len(notes) * 3)
+	out[0::3] = bytes(byte0)
+	out[1::3] = bytes(byte1)
+	out[2::3] = bytes(byte2)
 	return bytes(out)
 
 
 
-def main():
-	global read_ptr
-	
-	data = open_fur_file(FILE_NAME)
-	
-	if read_bytes(data, 16) != b"-Furnace module-":
-		print("It's not a valid file or the decompression went wrong!")
-		return
-	
-	print("Version number: " + str(read_int(data, 2)))
-	read_ptr += 2
-	song_info_ptr = read_int(data, 4)
-	read_ptr = song_info_ptr
-	
-	if read_bytes(data, 4) != b"INFO":
-		print("INFO block not found correctly!")
+def hash_bytes(data):
+	return hashlib.sha256(data).hexdigest()
+
+def hash_file(path):
+	file = open(path, "rb")
+	data = file.read()
+	file.close()
+	return hash_bytes(data)
+
+BUILD_STATE_VERSION = hash_file(__file__) # the state is dropped when the converter itself changes, since its results could be different now
+
+def load_build_state(path):
+	if path != None and os.path.exists(path):
+		file = open(path, "r")
+		state = json.load(file)
+		file.close()
+		if state["version"] == BUILD_STATE_VERSION:
+			return state
+	
+	return {"version": BUILD_STATE_VERSION, "instruments": {}, "wavetables": {}, "patterns": {}}
+
+def save_build_state(path, state):
+	if path == None:
 		return
-	
-	print("=========== INFO block size: " + str(read_int(data, 4)))
-	print("Time base: " + str(read_int(data, 1)))
-	print("Speed 1: " + str(read_int(data, 1)))
-	print("Speed 2: " + str(read_int(data, 1)))
-	print("Initial arp time: " + str(read_int(data, 1)))
-	print("Ticks per second: " + str(read_float4(data)))
-	pattern_length = read_int(data, 2)
-	print("Pattern length: " + str(pattern_length))
-	orders_length = read_int(data, 2)
-	print("Orders length: " + str(orders_length))
-	print("Highlight A: " + str(read_int(data, 1)))
-	print("Highlight B: " + str(read_int(data, 1)))
-	
-	instrument_count = read_int(data, 2)
-	print("Instrument count: " + str(instrument_count))
-	wavetable_count = read_int(data, 2)
-	print("Wavetable count: " + str(wavetable_count))
-	sample_count = read_int(data, 2)
-	print("Sample count: " + str(sample_count))
-	pattern_count = read_int(data, 4)
-	print("Pattern count: " + str(pattern_count))
-	
-	print("Sound chips:")
-	soundchip_bytes = read_bytes(data, 32)
-	for b in soundchip_bytes:
-		if b == 0:
-			break
-		else:
-			print(b)
-	soundchip_volumes = read_bytes(data, 32)
-	soundchip_panning = read_bytes(data, 32)
-	soundchip_flagptrs = read_bytes(data, 128)
-	
-	print("Song name: " + str(read_string(data)))
-	print("Song author: " + str(read_string(data)))
-	print("A-4 tuning: " + str(read_float4(data)))
-	print("Limit slides: " + str(read_int(data, 1)))
-	print("Linear pitch: " + str(read_int(data, 1)))
-	print("Loop modality: " + str(read_int(data, 1)))
-	print("Proper noise layout: " + str(read_int(data, 1)))
-	print("Wave duty is volume: " + str(read_int(data, 1)))
-	print("Reset macro on porta: " + str(read_int(data, 1)))
-	print("Legacy volume slides: " + str(read_int(data, 1)))
-	print("Compatible arpeggio: " + str(read_int(data, 1)))
-	print("Note off resets slides: " + str(read_int(data, 1)))
-	print("Target resets slides: " + str(read_int(data, 1)))
-	print("Arpeggio inhibits portamento: " + str(read_int(data, 1)))
-	print("Wack algorithm macro: " + str(read_int(data, 1)))
-	print("Broken shortcut slides: " + str(read_int(data, 1)))
-	print("Ignore duplicate slides: " + str(read_int(data, 1)))
-	print("Stop portamento on note off: " + str(read_int(data, 1)))
-	print("Continuous vibrato: " + str(read_int(data, 1)))
-	print("Broken DAC mode: " + str(read_int(data, 1)))
-	print("One tick cut: " + str(read_int(data, 1)))
-	print("Instrument change allowed during porta: " + str(read_int(data, 1)))
-	print("Reset note base on arpeggio effect stop: " + str(read_int(data, 1)))
-	
-	instrument_ptrs = read_ints(data, 4, instrument_count)
-	print("Instrument pointers: " + str(instrument_ptrs))
-	wavetable_ptrs = read_ints(data, 4, wavetable_count)
-	print("Wavetable pointers: " + str(wavetable_ptrs))
-	sample_ptrs = read_ints(data, 4, sample_count)
-	print("Sample pointers: " + str(sample_ptrs))
-	pattern_ptrs = read_ints(data, 4, pattern_count)
-	print("Pattern pointers: " + str(pattern_ptrs))
-	
-	orders = read_bytes(data, CHANNEL_COUNT * orders_length)
-	print("Orders: " + str(orders))
-	effect_columns = read_bytes(data, CHANNEL_COUNT)
-	print("Effect columns: " + str(effect_columns))
-	channel_hide_status = read_bytes(data, CHANNEL_COUNT)
-	channel_collapse_status = read_bytes(data, CHANNEL_COUNT)
-	print("Channel names: " + str(read_strings(data, CHANNEL_COUNT)))
-	print("Channel short names: " + str(read_strings(data, CHANNEL_COUNT)))
-	print("Song comment: " + str(read_string(data)))
-	print("Master volume: " + str(read_float4(data)))
-	print("Extended compatibility flags: " + str(read_bytes(data, 28)))
-	print("Virtual tempo numerator: " + str(read_int(data, 2)))
-	print("Virtual tempo denominator: " + str(read_int(data, 2)))
-	print("First subsong name: " + str(read_string(data)))
-	print("First subsong comment: " + str(read_string(data)))
-	subsong_count = read_int(data, 1)
-	print("Subsong count: " + str(subsong_count))
-	read_ptr += 3
-	subsong_ptrs = read_ints(data, 4, subsong_count)
-	print("Subsong pointers: " + str(subsong_ptrs))
-	print("System name: " + str(read_string(data)))
-	print("Album/category/game name: " + str(read_string(data)))
-	print("Song name (JP): " + str(read_string(data)))
-	print("Song author (JP): " + str(read_string(data)))
-	print("System name (JP): " + str(read_string(data)))
-	print("Album/category/game name (JP): " + str(read_string(data)))
-	print("Chip volume: " + str(read_float4(data)))
-	print("Chip panning: " + str(read_float4(data)))
-	print("Chip balance: " + str(read_float4(data)))
-	patchbay_connection_count = read_int(data, 4)
-	patchbay_connections = read_ints(data, 4, patchbay_connection_count)
-	print("Patchbay connections: " + str(patchbay_connections))
-	print("Automatic patchbay: " + str(read_int(data, 1)))
-	print("Broken portamento during legato: " + str(read_int(data, 1)))
-	read_ptr += 7
-	print("Speed pattern speed: " + str(read_int(data, 1)))
-	print("Speed pattern: " + str(read_bytes(data, 16)))
-	print("Groove entries: " + str(read_int(data, 1)))
+	save_file(path, json.dumps(state))
+
+
+
+class Profiler:
+	# measures the wall time, CPU time and peak memory of every stage of the conversion
+	# memory is only traced when enabled, since tracing slows everything down
+	def __init__(self, enabled):
+		self.enabled = enabled
+		self.stages = {}
+		self.stage = None
+		profile_counters.clear()
+		if self.enabled:
+			tracemalloc.start()
+	
+	def start(self, name):
+		# stops the current stage, if any
+		self.stop()
+		self.stage = name
+		self.wall_time = time.perf_counter()
+		self.cpu_time = time.process_time()
+		if self.enabled:
+			tracemalloc.reset_peak()
+	
+	def stop(self):
+		if self.stage == None:
+			return
+		stage = {"wall_time": time.perf_counter() - self.wall_time, "cpu_time": time.process_time() - self.cpu_time}
+		if self.enabled:
+			stage["peak_memory"] = tracemalloc.get_traced_memory()[1]
+		self.stages[self.stage] = stage
+		self.stage = None
+	
+	def finish(self):
+		# stops the last stage and the memory tracing
+		self.stop()
+		if self.enabled and tracemalloc.is_tracing():
+			tracemalloc.stop()
+	
+	def save(self, path):
+		report = {"stages": self.stages, "counters": profile_counters}
+		file = open(path, "w")
+		json.dump(report, file, indent = "\t")
+		file.close()
+
+
+
+def convert(fur_path, cart_path, music_data_path, jobs = 1, source_cart_path = None, state_path = None, parse_cache = None, profile_path = None, inject = False):
+	# the chunks are patched into the cart at source_cart_path (cart_path itself by default) and saved to cart_path
+	# with inject, the music data is also put into the code of the cart, see inject_music_data
+	# with state_path, only the parts of the module which changed since the last build with the same state are converted again
+	# with profile_path, a report of the time and memory taken by every stage and the work done is saved there,
+	# also when the conversion fails, with the stages done until then
+	# returns False if the module couldn't be read
+	profiler = Profiler(profile_path != None)
+	try:
+		return convert_module(profiler, fur_path, cart_path, music_data_path, jobs, source_cart_path, state_path, parse_cache, inject)
+	finally:
+		profiler.finish()
+		if profile_path != None:
+			profiler.save(profile_path)
+
+def convert_module(profiler, fur_path, cart_path, music_data_path, jobs, source_cart_path, state_path, parse_cache, inject):
+	# the stages of convert, each one measured by the profiler
+	profiler.start("parse")
+	module = FurModule(open_fur_file(fur_path, True), parse_cache)
+	if module.info == None:
+		return False
+	orders_length = module.info["orders_length"]
+	orders = module.info["orders"]
 	
 	instruments = []
-	for i in range(len(instrument_ptrs)):
-		print("=========== Instrument " + str(i))
-		instrument = get_instrument(data, instrument_ptrs[i])
+	for i in range(module.info["instrument_count"]):
+		logger.debug("=========== Instrument %s", i)
+		instrument = module.get_instrument(i)
 		instruments.append(instrument)
-		print(str(instrument))
+		logger.debug("%s", instrument)
 	
 	wavetables = []
-	for i in range(len(wavetable_ptrs)):
-		print("=========== Wavetable " + str(i))
-		wavetable = get_wavetable(data, wavetable_ptrs[i])
+	for i in range(module.info["wavetable_count"]):
+		logger.debug("=========== Wavetable %s", i)
+		wavetable = module.get_wavetable(i)
 		wavetables.append(wavetable)
 		#print(str(wavetable))
 	
 	patterns = []
-	for i in range(len(pattern_ptrs)):
-		print("=========== Pattern " + str(i))
-		pattern = get_pattern(data, pattern_ptrs[i], pattern_length, effect_columns)
+	for i in range(module.info["pattern_count"]):
+		logger.debug("=========== Pattern %s", i)
+		pattern = module.get_pattern(i)
 		patterns.append(pattern)
 		#print(str(pattern))
+	add_counter("rows_parsed", module.info["pattern_length"] * len(patterns)) # counted here, so that the parsers don't touch any globals
 	
+	profiler.start("tracks")
+	pattern_index = index_patterns(patterns)
 	pattern_order = []
 	tracks = []
 	order = 0
@@ -786,20 +1475,12 @@ def main():
 				vals = [0, 0, 0, 0] # patterns for four channels
 				skip_second_half = False
 				for channel in range(4):
-					pattern_in_channel = 0
-					pattern_in_total = 0
-					for pattern in patterns:
-						if pattern["channel"] != channel:
-							pattern_in_total += 1
-							continue
-						if pattern_in_channel == orders[channel * orders_length + order]:
-							vals[channel] = pattern_in_total
-							if pattern["rows"][63]["effects"][0] == 13: # is there a "jump to next pattern" command in the middle of a pattern?
-								print("Jump found in pattern!")
-								skip_second_half = True
-							break
-						pattern_in_channel += 1
-						pattern_in_total += 1
+					key = (channel, orders[channel * orders_length + order])
+					if key in pattern_index["patterns"]:
+						vals[channel] = pattern_index["patterns"][key]
+						if vals[channel] in pattern_index["jumps"]:
+							logger.debug("Jump found in pattern!")
+							skip_second_half = True
 				# insert both halves (unless we're skipping the second one)
 				for k in range(2):
 					if start_from_second_half: # skip first half if we're starting from the second one
@@ -828,75 +1509,130 @@ def main():
 		track.append(0)
 		
 		tracks.append(track)
-		print("Track " + str(i) + ": " + str(track) + " (len " + str(len(track)) + ")")
-		print("Encoded: " + encode_base64(track) + " (len " + str(len(encode_base64(track))) + ")")
+		logger.debug("Track %s: %s (len %s)", i, track, len(track))
+		if logger.isEnabledFor(logging.DEBUG):
+			encoded_track = encode_base64(track)
+			logger.debug("Encoded: %s (len %s)", encoded_track, len(encoded_track))
+	
 	
 	
+	# Conversion; instruments, wavetables and patterns which haven't changed since the last build are taken from its state
+	profiler.start("convert_wavetables")
+	old_state = load_build_state(state_path)
+	state = {"version": old_state["version"], "instruments": {}, "wavetables": {}, "patterns": {}}
 	
-	# Conversion
 	converted_wavetables = b""
-	print("Converted wavetables:")
-	for wavetable in wavetables:
-		converted = convert_wavetable(wavetable)
+	logger.debug("Converted wavetables:")
+	for i in range(len(wavetables)):
+		key = hash_bytes(module.get_block(module.info["wavetable_ptrs"][i]))
+		if key in old_state["wavetables"]:
+			converted = bytes.fromhex(old_state["wavetables"][key])
+		else:
+			converted = convert_wavetable(wavetables[i])
+		state["wavetables"][key] = converted.hex()
 		converted_wavetables += converted
-		print(str(wavetable))
+		logger.debug("%s", wavetables[i])
 		#print(str(converted))
 	
+	profiler.start("convert_instruments")
 	converted_instruments = b""
-	print("Converted instruments:")
-	for instrument in instruments:
-		converted = convert_instrument(instrument)
+	logger.debug("Converted instruments:")
+	for i in range(len(instruments)):
+		key = hash_bytes(module.get_block(module.info["instrument_ptrs"][i]))
+		if key in old_state["instruments"]:
+			converted = bytes.fromhex(old_state["instruments"][key])
+		else:
+			converted = convert_instrument(instruments[i])
+		state["instruments"][key] = converted.hex()
 		converted_instruments += converted
 		#print(str(converted))
 	
+	profiler.start("convert_patterns")
 	converted_patterns = b""
-	print("Converted patterns:")
+	logger.debug("Converted patterns:")
 	prev_pattern = None
-	b64_patterns = []
-	pattern_repl_map = {}
-	for pattern in patterns:
-		converted = convert_pattern(pattern, prev_pattern)
+	prev_block = b""
+	pattern_keys = []
+	b64_tests = []
+	b64_patterns = [] # compressed b64_tests, None if they weren't in the last build
+	pattern_slots = {} # converted pattern half -> its number in b64_tests, counting from 1
+	half_slots = [] # the slot of every pattern half, in order
+	for i in range(len(patterns)):
+		block = module.get_block(module.info["pattern_ptrs"][i])
+		key = hash_bytes(prev_block + block) # the previous pattern affects the conversion too
+		pattern_keys.append(key)
+		if key in old_state["patterns"]:
+			converted = bytes.fromhex(old_state["patterns"][key]["converted"])
+			compressed = old_state["patterns"][key]["compressed"]
+		else:
+			converted = convert_pattern(patterns[i], prev_pattern)
+			compressed = [None, None]
+		state["patterns"][key] = {"converted": converted.hex()}
 		converted_patterns += converted
 		#print(str(converted))
 		
-		for i in range(2):
-			b64_test = encode_base64(converted[i*192:(i+1)*192]).replace("AAAI", "@").replace("IAA", "$").replace("IAQh", "%").replace("Ago", "^")
-			print("compressing: " + str(b64_test))
-			b64_pattern = compress_base64(b64_test)
-			if b64_pattern in b64_patterns:
-				print("oops! it's already there! skipping...")
-				#pattern_repl_map[len(b64_patterns) + 1]
-				for frame in pattern_order:
-					for j in range(len(frame)):
-						if frame[j] == len(b64_patterns) + 1:
-							frame[j] = b64_patterns.index(b64_pattern) + 1
-						elif frame[j] > len(b64_patterns) + 1:
-							frame[j] -= 1
+		for j in range(2):
+			half = converted[j*192:(j+1)*192]
+			if half in pattern_slots:
+				logger.debug("oops! it's already there! skipping...")
 			else:
-				b64_patterns.append(b64_pattern)
+				b64_test = shorten_base64(encode_base64(half))
+				add_counter("base64_bytes_in", len(half))
+				add_counter("base64_bytes_out", len(b64_test))
+				logger.debug("compressing: %s", b64_test)
+				b64_tests.append(b64_test)
+				b64_patterns.append(compressed[j])
+				pattern_slots[half] = len(b64_tests)
+			half_slots.append(pattern_slots[half])
 		
-		prev_pattern = pattern
-	
-	comp_huff_map = generate_huffman_tree(count_bytes("".join(b64_patterns)))
-	comp_huff_map_inv = invert_huffman_mapping(comp_huff_map)
+		prev_pattern = patterns[i]
+		prev_block = block
+	
+	profiler.start("compress")
+	# the halves kept from the last build already went through the Huffman cost rounds, only the new ones are compressed
+	compress_cache = CompressCache(COMPRESS_CACHE_NAME)
+	missing = [i for i in range(len(b64_tests)) if b64_patterns[i] == None]
+	if len(missing) > 0:
+		compressed = compress_cache.compress_all([b64_tests[i] for i in missing], jobs)
+		for i, result in zip(missing, compressed):
+			b64_patterns[i] = result
+	b64_patterns, comp_huff_lengths = recompress_for_huffman(b64_tests, b64_patterns, missing, lambda data, costs: compress_cache.compress_all(data, jobs, costs))
+	compress_cache.close()
+	for i in range(len(pattern_keys)):
+		state["patterns"][pattern_keys[i]]["compressed"] = [b64_patterns[half_slots[i*2] - 1], b64_patterns[half_slots[i*2+1] - 1]]
+	
+	# point the orders at the deduplicated pattern halves
+	for frame in pattern_order:
+		for j in range(len(frame)):
+			frame[j] = half_slots[frame[j] - 1]
+	
+	add_counter("compress_bytes_in", sum([len(test) for test in b64_tests]))
+	add_counter("compress_bytes_out", sum([len(pattern) for pattern in b64_patterns]))
+	
+	profiler.start("huffman")
+	comp_huff_map = generate_canonical_huffman_codes(comp_huff_lengths)
+	comp_huff_lookup = build_huffman_lookup(comp_huff_map)
+	add_counter("huffman_symbols", len(comp_huff_map))
 	comp_test_bytes = 0
 	for i in range(len(b64_patterns)):
 		pattern = encode_base64(compress_huffman(b64_patterns[i], comp_huff_map))
 		comp_test_bytes += len(pattern)
-		print(pattern)
+		add_counter("huffman_bytes_in", len(b64_patterns[i]))
+		add_counter("huffman_bytes_out", len(pattern))
+		logger.debug("%s", pattern)
 		step1 = decode_base64(pattern)
 		#print("Decoding step 1: " + str(step1))
-		step2 = decompress_huffman(step1, comp_huff_map_inv)
+		step2 = decompress_huffman(step1, comp_huff_lookup).decode()
 		#print("Decoding step 2: " + str(step2))
-		step3 = decompress_base64(step2.replace("@", "AAAI").replace("$", "IAA").replace("%", "IAQh").replace("^", "Ago"))
+		step3 = decompress_base64(expand_base64(step2))
 		#print("Decoding step 3: " + str(step3))
 		step4 = decode_base64(step3)
 		#print("Decoding step 4: " + str(step4))
 		if not step4 in converted_patterns:
-			print("ERROR!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!")
-		print(str(i) + " " + str(len(step1)) + " " + str(len(step2)) + " " + str(len(step3)) + " " + str(len(step4)))
+			logger.error("ERROR!!! Pattern half %s doesn't decode back to a converted pattern", i)
+		logger.debug("%s %s %s %s %s", i, len(step1), len(step2), len(step3), len(step4))
 		b64_patterns[i] = pattern
-	print("Bytes after (real): " + str(comp_test_bytes))
+	logger.info("Bytes after (real): %s", comp_test_bytes)
 	
 	
 	converted_tracks = b""
@@ -906,39 +1642,33 @@ def main():
 	
 	
 	# TIC and export
-	cart_data = open_tic_file(CARTRIDGE_NAME)
-	cart_chunks = unpack_tic_cart(cart_data)
-	replace_tic_chunk(cart_chunks, 10, converted_wavetables)
-	replace_tic_chunk(cart_chunks, 9, converted_instruments)
-	replace_tic_chunk(cart_chunks, 15, converted_patterns)
-	replace_tic_chunk(cart_chunks, 14, converted_tracks)
-	new_cart_data = pack_tic_cart(cart_chunks)
-	save_tic_file(CARTRIDGE_NAME, new_cart_data)
-	
+	profiler.start("export")
 	music_data = "M_DATA = {\n"
 	for pattern in b64_patterns:
 		music_data += "\t\"" + pattern + "\",\n"
 	music_data += "}\n"
 	
-	comp_huff_map_inv_l = [None, None]
-	current_table = comp_huff_map_inv_l
-	for key in comp_huff_map_inv:
-		byte = comp_huff_map_inv[key]
-		for i in range(len(key)):
-			bit = int(key[i])
-			if i < len(key) - 1:
-				if current_table[bit] == None:
-					current_table[bit] = [None, None]
-				current_table = current_table[bit]
-			else:
-				current_table[bit] = byte
-				current_table = comp_huff_map_inv_l
-	music_data += "M_CODE = " + str(comp_huff_map_inv_l).replace("[", "{").replace("]", "}").replace(", ", ",").replace("'", "\"") + "\n"
+	music_data += "M_CODE = " + serialize_huffman_tree(comp_huff_map) + "\n"
 	music_data += "M_PATTERNS = " + str(pattern_order).replace("[", "{").replace("]", "}").replace(", ", ",") + "\n"
 	
-	file = open("music_data.txt", "w")
-	file.write(music_data)
-	file.close()
+	cart = TicCart(open_tic_file(source_cart_path or cart_path))
+	cart.replace_chunk(10, converted_wavetables)
+	cart.replace_chunk(9, converted_instruments)
+	cart.replace_chunk(15, converted_patterns)
+	cart.replace_chunk(14, converted_tracks)
+	if inject:
+		# the code is kept byte for byte, whatever its encoding
+		cart.set_code(inject_music_data(cart.get_code().decode("latin-1"), music_data).encode("latin-1"))
+	if source_cart_path == None and not cart.is_changed():
+		logger.debug("%s hasn't changed, not saving it", cart_path) # so that TIC-80 doesn't reload it for nothing
+	else:
+		save_file(cart_path, cart.pack())
+	
+	save_file(music_data_path, music_data)
+	
+	save_build_state(state_path, state)
+	
+	return True
 	
 	
 	
@@ -949,4 +1679,160 @@ def main():
 
 
 
-main()
\ No newline at end of file
+def find_fur_files(paths):
+	# the paths can be .fur files, directories with them or manifests listing one path per line
+	out = []
+	for path in paths:
+		if os.path.isdir(path):
+			for name in sorted(os.listdir(path)):
+				if name.endswith(".fur"):
+					out.append(os.path.join(path, name))
+		elif path.endswith(".fur"):
+			out.append(path)
+		else:
+			file = open(path, "r")
+			lines = file.read().split("\n")
+			file.close()
+			for line in lines:
+				line = line.strip()
+				if line != "" and not line.startswith("#"):
+					out += find_fur_files([os.path.join(os.path.dirname(path), line)])
+	
+	return out
+
+def get_song_names(fur_paths):
+	# the names of the batch outputs: the file names, with a number added to the ones already taken by an earlier song
+	# they're compared ignoring the case, since the output directory could be on a file system which does that
+	names = []
+	taken = set()
+	for path in fur_paths:
+		base = os.path.splitext(os.path.basename(path))[0]
+		name = base
+		n = 2
+		while name.lower() in taken:
+			name = base + "_" + str(n)
+			n += 1
+		taken.add(name.lower())
+		names.append(name)
+	
+	return names
+
+def convert_song(fur_path, name, output_dir, inject = False, level = logging.INFO):
+	# batch worker: converts one module into its own cart, music data and log in the output directory, named after name
+	# the level is set here, since a worker started by spawning a new interpreter doesn't get the logging setup of main
+	cart_path = os.path.join(output_dir, name + ".tic")
+	music_data_path = os.path.join(output_dir, name + "_music_data.txt")
+	state_path = os.path.join(output_dir, name + "_build_state.json")
+	out = {"name": name, "success": False, "time": 0, "cart_size": 0, "music_data_size": 0}
+	
+	start_time = time.perf_counter()
+	log = open(os.path.join(output_dir, name + ".log"), "w")
+	handler = logging.StreamHandler(log)
+	logger.addHandler(handler)
+	logger.setLevel(level)
+	logger.propagate = False # the song's log goes only to its file
+	try:
+		out["success"] = convert(fur_path, cart_path, music_data_path, 1, CARTRIDGE_NAME, state_path, None, None, inject)
+	except Exception as e:
+		log.write(traceback.format_exc())
+	logger.removeHandler(handler)
+	logger.propagate = True
+	log.close()
+	out["time"] = time.perf_counter() - start_time
+	if out["success"]:
+		out["cart_size"] = os.path.getsize(cart_path)
+		out["music_data_size"] = os.path.getsize(music_data_path)
+	
+	return out
+
+def batch_convert(paths, output_dir, jobs = 1, inject = False, level = logging.INFO):
+	fur_paths = []
+	for path in find_fur_files(paths):
+		if not os.path.normpath(path) in fur_paths: # the same song can be listed more than once
+			fur_paths.append(os.path.normpath(path))
+	os.makedirs(output_dir, exist_ok = True)
+	start_time = time.perf_counter()
+	with ProcessPoolExecutor(jobs) as executor:
+		results = list(executor.map(convert_song, fur_paths, get_song_names(fur_paths), [output_dir] * len(fur_paths), [inject] * len(fur_paths), [level] * len(fur_paths)))
+	
+	print("Song".ljust(32) + "Time (s)".rjust(10) + "Cart".rjust(10) + "Music data".rjust(12))
+	for result in results:
+		if result["success"]:
+			print(result["name"].ljust(32) + ("%.2f" % result["time"]).rjust(10) + str(result["cart_size"]).rjust(10) + str(result["music_data_size"]).rjust(12))
+		else:
+			print(result["name"].ljust(32) + ("%.2f" % result["time"]).rjust(10) + "  FAILED, see " + result["name"] + ".log")
+	successes = len([result for result in results if result["success"]])
+	print(str(successes) + " of " + str(len(results)) + " songs converted in " + ("%.2f" % (time.perf_counter() - start_time)) + " s")
+
+
+
+def get_file_stat(path):
+	if not os.path.exists(path):
+		return None
+	stat = os.stat(path)
+	return (stat.st_mtime_ns, stat.st_size)
+
+def watch(fur_path, cart_path, music_data_path, state_path, jobs = 1, inject = False):
+	# converts the module every time it's saved; parsed blocks and compressed strings stay in memory between the conversions
+	parse_cache = {}
+	last_stat = None
+	logger.info("Watching %s, press Ctrl+C to stop", fur_path)
+	try:
+		while True:
+			stat = get_file_stat(fur_path)
+			if stat != None and stat != last_stat:
+				# wait until the file stops changing, so that a save in progress isn't read
+				time.sleep(WATCH_DEBOUNCE)
+				if get_file_stat(fur_path) != stat:
+					continue
+				last_stat = stat
+				start_time = time.perf_counter()
+				try:
+					success = convert(fur_path, cart_path, music_data_path, jobs, None, state_path, parse_cache, None, inject)
+				except Exception:
+					logger.exception("Error while converting %s", fur_path)
+					success = False
+				if success:
+					logger.info("Converted in %.2f s, watching for changes...", time.perf_counter() - start_time)
+				else:
+					logger.info("Conversion failed, watching for changes...")
+			time.sleep(WATCH_INTERVAL)
+	except KeyboardInterrupt:
+		logger.info("Stopped watching")
+
+
+
+def main():
+	parser = argparse.ArgumentParser(description = "Converts " + FILE_NAME + " into the music of " + CARTRIDGE_NAME + " and " + MUSIC_DATA_NAME + ".")
+	parser.add_argument("--jobs", type = int, default = 1, help = "compress the pattern halves (or convert the songs, with --batch) in this many processes")
+	parser.add_argument("--batch", nargs = "+", metavar = "PATH", help = ".fur files, directories with them or manifests listing them; each song is converted into its own cart and music data, using " + CARTRIDGE_NAME + " as the template")
+	parser.add_argument("--rebuild", action = "store_true", help = "convert everything again instead of reusing the unchanged parts from " + BUILD_STATE_NAME)
+	parser.add_argument("--watch", action = "store_true", help = "convert again every time the module is saved")
+	parser.add_argument("--output", default = "batch", help = "where the --batch results are saved (default: batch)")
+	parser.add_argument("--inject", action = "store_true", help = "also put the music data into the code of the cart, between the " + MUSIC_DATA_START + " and " + MUSIC_DATA_END + " lines (or in place of the tables pasted from " + MUSIC_DATA_NAME + ")")
+	parser.add_argument("--verbose", action = "store_true", help = "print everything that's read and converted")
+	parser.add_argument("--quiet", action = "store_true", help = "print only warnings and errors")
+	parser.add_argument("--profile", nargs = "?", const = PROFILE_NAME, metavar = "PATH", help = "save the time and peak memory of every stage and the amounts of work done to a JSON report (default: " + PROFILE_NAME + ")")
+	args = parser.parse_args()
+	
+	level = logging.INFO
+	if args.verbose:
+		level = logging.DEBUG
+	elif args.quiet:
+		level = logging.WARNING
+	logging.basicConfig(format = "%(message)s", level = level, stream = sys.stdout)
+	
+	if args.batch:
+		batch_convert(args.batch, args.output, args.jobs, args.inject, level)
+	else:
+		if args.rebuild and os.path.exists(BUILD_STATE_NAME):
+			os.remove(BUILD_STATE_NAME)
+		if args.watch:
+			watch(FILE_NAME, CARTRIDGE_NAME, MUSIC_DATA_NAME, BUILD_STATE_NAME, args.jobs, args.inject)
+		else:
+			convert(FILE_NAME, CARTRIDGE_NAME, MUSIC_DATA_NAME, args.jobs, None, BUILD_STATE_NAME, None, args.profile, args.inject)
+
+
+
+if __name__ == "__main__":
+	main()
@@ -0,0 +1,59 @@
+from main import decode_base64, decompress_base64, expand_base64, deserialize_huffman_tree, build_huffman_lookup, decompress_huffman
+
+MUSIC_DATA_NAME = "music_data.txt"
+OUTPUT_NAME = "music_data.bin"
+
+
+
+def read_music_data(path):
+	file = open(path, "r")
+	lines = file.read().split("\n")
+	file.close()
+	
+	patterns = []
+	code = None
+	in_data = False
+	for line in lines:
+		if line.startswith("M_DATA = {"):
+			in_data = True
+		elif in_data and line == "}":
+			in_data = False
+		elif in_data:
+			patterns.append(line.strip().strip(",").strip("\""))
+		elif line.startswith("M_CODE = "):
+			code = line[len("M_CODE = "):]
+	
+	return patterns, code
+
+
+
+def main():
+	patterns, code = read_music_data(MUSIC_DATA_NAME)
+	if code == None:
+		print("M_CODE not found in " + MUSIC_DATA_NAME + "!")
+		return
+	
+	try:
+		lookup = build_huffman_lookup(deserialize_huffman_tree(code))
+	except (ValueError, IndexError):
+		print("The Huffman codes in " + MUSIC_DATA_NAME + " aren't in a format this decoder knows!")
+		return
+	out = bytearray()
+	for i in range(len(patterns)):
+		step1 = decode_base64(patterns[i])
+		step2 = decompress_huffman(step1, lookup).decode()
+		step3 = decompress_base64(expand_base64(step2))
+		step4 = decode_base64(step3)
+		if len(step4) != 192:
+			print("Pattern " + str(i) + " decodes to " + str(len(step4)) + " bytes instead of 192!")
+		print(str(i) + ": " + step4.hex())
+		out += step4
+	
+	file = open(OUTPUT_NAME, "wb")
+	file.write(out)
+	file.close()
+
+
+
+if __name__ == "__main__":
+	main()